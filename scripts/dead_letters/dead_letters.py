@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Inspect and requeue the dead letters of a work queue.
+
+Queues are named as in a run_topology config, for instance
+
+  dead_letters.py -c config.yml tweet_queue list
+  dead_letters.py -c config.yml tweet_queue requeue -n 100
+
+Listing shows each dead letter decoded by the queue's decoder where possible, else raw. Requeueing
+moves dead letters back to the end of the queue with fresh attempt counts, so only requeue once
+whatever made them fail has been fixed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from skrode.config import Config
+from skrode.redis import stream
+
+
+args = argparse.ArgumentParser()
+args.add_argument("-c", "--config",
+                  dest="config",
+                  default="config.yml")
+args.add_argument("queue",
+                  help="The name of the queue in the config")
+args.add_argument("command",
+                  choices=["list", "requeue"])
+args.add_argument("-n", "--limit",
+                  dest="limit",
+                  default=None,
+                  type=int,
+                  help="The most dead letters to list or requeue. Default all.")
+
+
+def _decode(queue, raw):
+  try:
+    return queue._decoder(raw)
+  except Exception:
+    return raw
+
+
+def list_dead_entries(name, queue, dead, limit):
+  # Dead letters already requeued have been read by the dead letters' group, but may not have been
+  # trimmed yet, so only the entries after the group's last delivered ID are listed.
+  group = dead._group.encode("utf-8") if not isinstance(dead._group, bytes) else dead._group
+  last = next(info["last-delivered-id"] for info in dead._conn.xinfo_groups(dead._key)
+              if info["name"] in (group, dead._group))
+  if isinstance(last, bytes):
+    last = last.decode("utf-8")
+  for id, fields in dead._conn.xrange(dead._key, "(%s" % (last,), "+", count=limit):
+    print("%s\t%s\t%r" % (name, id.decode("utf-8"), _decode(queue, fields[b"v"])))
+
+
+def list_dead(name, queue, dead, limit):
+  if isinstance(dead, stream.WorkQueue):
+    list_dead_entries(name, queue, dead, limit)
+    return
+
+  seq = dead._producer._list
+  # Dead letters already requeued are claimed, but may not have been collected yet.
+  start = len(seq) - len(dead)
+  end = len(seq) if limit is None else min(len(seq), start + limit)
+  for idx in range(start, end):
+    print("%s\t%d\t%r" % (name, idx, _decode(queue._consumer, seq[idx])))
+
+
+def main(opts):
+  config = Config(config=opts.config)
+  queue = config.get(opts.queue)
+
+  if opts.command == "requeue":
+    print("Requeued %d dead letters" % (queue.requeue_dead(opts.limit),))
+    return
+
+  dead = queue.dead_letters()
+  if isinstance(dead, dict):
+    # A priority or partitioned queue, with dead letters per lane or partition
+    member = queue.lane if hasattr(queue, "lane") else queue.partition
+    for name in sorted(dead):
+      list_dead("%s/%s" % (opts.queue, name), member(name), dead[name], opts.limit)
+  else:
+    list_dead(opts.queue, queue, dead, opts.limit)
+
+
+if __name__ == "__main__":
+  main(args.parse_args(sys.argv[1:]))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark the work queue backends against each other on the same Redis.
+
+For each backend, fills a queue with tweet ID sized JSON payloads in batches, then drains it in
+batches completing every item, reporting put and get throughput and the growth of Redis'
+`used_memory` once full. The target database is flushed before and after every run, so point this
+at a scratch database. The stream backend needs Redis 6.2 or later.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from skrode.redis import stream, workqueue
+
+from redis import StrictRedis
+
+
+BACKENDS = {
+  "keys": lambda conn, key: workqueue.WorkQueue(conn, key, encoder=json.dumps),
+  "chunked": lambda conn, key: workqueue.WorkQueue(conn, key, encoder=json.dumps, chunk_size=128),
+  "stream": lambda conn, key: stream.WorkQueue(conn, key, encoder=json.dumps),
+}
+
+args = argparse.ArgumentParser()
+args.add_argument("--host", dest="host", default="localhost")
+args.add_argument("--port", dest="port", default=6379, type=int)
+args.add_argument("--db", dest="db", default=15, type=int)
+args.add_argument("-n", "--items",
+                  dest="items",
+                  default=1000000,
+                  type=int)
+args.add_argument("--backend",
+                  dest="backends",
+                  action="append",
+                  choices=sorted(BACKENDS),
+                  help="Backends to measure. Default all.")
+args.add_argument("--batch",
+                  dest="batch",
+                  default=1000,
+                  type=int)
+
+
+def used_memory(conn):
+  return conn.info("memory")["used_memory"]
+
+
+def measure(conn, backend, items, batch):
+  conn.flushdb()
+  before = used_memory(conn)
+  queue = BACKENDS[backend](conn, "/queue/twitter/tweet_ids/ready")
+
+  start = time.time()
+  for offset in range(0, items, batch):
+    queue.put_many([str(random.randint(10 ** 17, 10 ** 18))
+                    for _ in range(offset, min(offset + batch, items))])
+  put_elapsed = time.time() - start
+  used = used_memory(conn) - before
+
+  start = time.time()
+  while True:
+    claimed = queue.get_many(batch)
+    if not claimed:
+      break
+    for item in claimed:
+      item.complete()
+  get_elapsed = time.time() - start
+
+  conn.flushdb()
+  return put_elapsed, get_elapsed, used
+
+
+def main(opts):
+  conn = StrictRedis(opts.host, port=opts.port, db=opts.db)
+
+  print("%8s %12s %12s %14s" % ("backend", "puts/sec", "gets/sec", "bytes/item"))
+  for backend in opts.backends or sorted(BACKENDS):
+    put_elapsed, get_elapsed, used = measure(conn, backend, opts.items, opts.batch)
+    print("%8s %12.0f %12.0f %14.1f" % (backend, opts.items / put_elapsed,
+                                         opts.items / get_elapsed, used / float(opts.items)))
+
+
+if __name__ == "__main__":
+  main(args.parse_args(sys.argv[1:]))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Measure the Redis memory cost of a work queue under each storage layout.
+
+Fills a queue with tweet ID sized JSON payloads once per chunk size, reporting the growth of Redis'
+`used_memory` for each. The target database is flushed before and after every run, so point this at
+a scratch database.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from skrode.redis.workqueue import Producer
+
+from redis import StrictRedis
+
+
+args = argparse.ArgumentParser()
+args.add_argument("--host", dest="host", default="localhost")
+args.add_argument("--port", dest="port", default=6379, type=int)
+args.add_argument("--db", dest="db", default=15, type=int)
+args.add_argument("-n", "--items",
+                  dest="items",
+                  default=10000000,
+                  type=int)
+args.add_argument("--chunk-size",
+                  dest="chunk_sizes",
+                  action="append",
+                  type=int,
+                  help="Chunk sizes to measure, where 0 is one key per item. Default 0, 128, 1024.")
+args.add_argument("--batch",
+                  dest="batch",
+                  default=10000,
+                  type=int)
+
+
+def used_memory(conn):
+  return conn.info("memory")["used_memory"]
+
+
+def measure(conn, items, chunk_size, batch):
+  conn.flushdb()
+  before = used_memory(conn)
+  start = time.time()
+
+  producer = Producer(conn, "/queue/twitter/tweet_ids/ready",
+                      encoder=json.dumps, chunk_size=chunk_size)
+  for offset in range(0, items, batch):
+    producer.put_many([str(random.randint(10 ** 17, 10 ** 18))
+                       for _ in range(offset, min(offset + batch, items))])
+
+  used = used_memory(conn) - before
+  elapsed = time.time() - start
+  conn.flushdb()
+  return used, elapsed
+
+
+def main(opts):
+  conn = StrictRedis(opts.host, port=opts.port, db=opts.db)
+
+  print("%10s %14s %14s %10s" % ("chunk size", "used bytes", "bytes/item", "fill secs"))
+  for chunk_size in opts.chunk_sizes or [0, 128, 1024]:
+    used, elapsed = measure(conn, opts.items, chunk_size, opts.batch)
+    print("%10d %14d %14.1f %10.1f" % (chunk_size, used, used / float(opts.items), elapsed))
+
+
+if __name__ == "__main__":
+  main(args.parse_args(sys.argv[1:]))
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Dump a work queue to a file, or load a dump into a work queue.
+
+  queue_transfer.py --host old-redis dump /queue/twitter/tweet_ids/ready tweet_ids.ndjson.gz
+  queue_transfer.py --host new-redis load /queue/twitter/tweet_ids/ready tweet_ids.ndjson.gz
+
+Dumps are gzipped unless `--no-compress` is given. The chunk size of the queue must be given when
+it isn't 0, as the layout isn't recorded in Redis. See skrode.redis.transfer.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import gzip
+import sys
+import time
+
+from skrode.redis import transfer
+from skrode.redis.workqueue import Producer
+
+from redis import StrictRedis
+
+
+args = argparse.ArgumentParser()
+args.add_argument("--host", dest="host", default="localhost")
+args.add_argument("--port", dest="port", default=6379, type=int)
+args.add_argument("--db", dest="db", default=0, type=int)
+args.add_argument("--chunk-size", dest="chunk_size", default=0, type=int)
+args.add_argument("--format", dest="format", default="ndjson", choices=transfer.FORMATS)
+args.add_argument("--no-compress", dest="compress", action="store_false")
+args.add_argument("--start", dest="start", default=None, type=int,
+                  help="The first index to dump. Default the first uncollected item.")
+args.add_argument("--end", dest="end", default=None, type=int,
+                  help="The index to dump up to. Default the end of the queue.")
+args.add_argument("--batch", dest="batch", default=1024, type=int)
+args.add_argument("command", choices=["dump", "load"])
+args.add_argument("key")
+args.add_argument("path")
+
+
+def main(opts):
+  conn = StrictRedis(opts.host, port=opts.port, db=opts.db)
+  # A bare producer, so that neither command registers a consumer on the queue.
+  queue = Producer(conn, opts.key, chunk_size=opts.chunk_size)
+  opener = gzip.open if opts.compress else open
+
+  start = time.time()
+  if opts.command == "dump":
+    with opener(opts.path, "wb") as f:
+      n = transfer.dump(queue, f, start=opts.start, end=opts.end, format=opts.format,
+                        batch=opts.batch)
+  else:
+    with opener(opts.path, "rb") as f:
+      n = transfer.load(queue, f, format=opts.format, batch=opts.batch)
+
+  print("%sed %d items in %.1f secs" % (opts.command, n, time.time() - start))
+
+
+if __name__ == "__main__":
+  main(args.parse_args(sys.argv[1:]))
@@ -39,21 +39,41 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      port: 6379
      db: 0
 
+   # Further Redis nodes, over which queues may be spread by consistent hashing of their keys. Each
+   # queue (or each partition of a partitioned queue) lives wholly on one node.
+   redis_cluster:
+     &redis_cluster
+     !skrode/redis_cluster
+     nodes:
+       - *redis
+       - !skrode/redis
+         host: redis-2
+         port: 6379
+         db: 0
+
    # The queue topology
    ################################################################################
+   # Queues may also be Redis streams, which need Redis 6.2. See scripts/queue_benchmark.
    twitter_username_queue:
      &twitter_username_queue
-     !skrode/queue
+     !skrode/stream_queue
      conn: *redis
-     key: /queue/twitter/user_names/ready
-     inflight: /queue/twitter/user_names/inflight
+     key: /queue/twitter/user_names/stream
 
+   # User IDs are spread over 16 partitions by ID, so that no two twitter_user_ids processes ever
+   # ingest the same user at once
    twitter_user_id_queue:
      &twitter_user_id_queue
-     !skrode/queue
-     conn: *redis
+     !skrode/partitioned_queue
+     conn: *redis_cluster
+     partitions: 16
      key: /queue/twitter/user_ids/ready
      inflight: /queue/twitter/user_ids/inflight
+     # Hold failed IDs off for a minute before retrying, doubling per attempt up to an hour
+     retry_in: 60
+     max_retry_delay: 3600
+     # After five failed attempts, move an ID to the dead letters. See scripts/dead_letters.
+     max_attempts: 5
 
    twitter_user_queue:
      &twitter_user_queue
@@ -63,12 +83,25 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      inflight: /queue/twitter/users/inflight
 
    # Tweets can come in both by ID and as full JSON blobs..
+   #
+   # IDs from the live stream go to the first lane by default, and jump the backfill lane. Backfill
+   # still gets a tenth of claims.
    tweet_id_queue:
      &tweet_id_queue
-     !skrode/queue
+     !skrode/priority_queue
      conn: *redis
+     lanes: [live, backfill]
+     weights: [9, 1]
      key: /queue/twitter/tweet_ids/ready
      inflight: /queue/twitter/tweet_ids/inflight
+     # Store IDs as packed 8 byte integers, 128 to a hash rather than spending a key on each
+     codec: uint64
+     chunk_size: 128
+     # Drop IDs which were already enqueued within the last hour
+     dedupe: 3600
+     # Consumed items are collected by queue_collector, as are items older than a week
+     retention:
+       max_age: 604800
 
    tweet_queue:
      &tweet_queue
@@ -76,6 +109,15 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      conn: *redis
      key: /queue/twitter/tweets/ready
      inflight: /queue/twitter/tweets/inflight
+     codec: msgpack
+     compress: true
+
+   # Queues between workers on this host can skip Redis, and share a memory-mapped file instead
+   random_queue:
+     &random_queue
+     !skrode/local_queue
+     path: /var/run/skrode/random_queue
+     capacity: 67108864
 
    # Worker queue topology
    ################################################################################
@@ -87,6 +129,14 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      twitter_api: *twitter
      tweet_queue: *tweet_queue
      user_queue: *twitter_user_id_queue
+     # Back off restarts of a stream which keeps dropping within a minute of starting, from 5
+     # seconds doubling up to 10 minutes. After 3 such drops in a row restarts are held for the 10
+     # minutes, then a single trial replica is run. Send the master SIGUSR2 to log the state of
+     # every worker.
+     restart:
+       backoff: 5
+       max_backoff: 600
+       stable_after: 60
      # GetUserStream kwargs
      withuser: followings
      stall_warnings: True
@@ -97,6 +147,21 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      type: map
      target: ingest_twitter.ingest_user
      source: *twitter_user_id_queue
+     # Ingest up to 8 users at once, each thread with its own session. The queue is partitioned, so
+     # no two threads ever ingest the same user at once
+     concurrency: 8
+     # Alternatively `type: async_map` runs an event loop, awaiting coroutine targets with up to
+     # `inflight` items at once, and running blocking targets on a pool of `threads` threads
+     session: *sql
+     twitter_api: *twitter
+
+   # Or, hydrate user IDs 100 at a time, the most one users/lookup call takes
+   twitter_user_ids_batched:
+     type: batch
+     target: ingest_twitter.ingest_users
+     source: *twitter_user_id_queue
+     batch_size: 100
+     max_wait_ms: 5000
      session: *sql
      twitter_api: *twitter
 
@@ -104,38 +169,68 @@ Example-ish configuration, note use of !skrode/* ctors, provided by skrode.confi
      type: custom
      target: ingest_twitter.collect_empty_tweets
      session: *sql
-     tweet_id_queue: *tweet_id_queue
+     tweet_id_queue:
+       !skrode/lane
+       queue: *tweet_id_queue
+       lane: backfill
 
    twitter_tweet_ids:
      type: map
      target: ingest_twitter.ingest_tweet_id
      source: *tweet_id_queue
+     # Claim up to 32 IDs ahead, so that no time is spent waiting on Redis between tweets
+     prefetch: 32
+     # Run between 2 and 8 of these, adding one while the backlog would take over a minute to drain
+     # and retiring one while it would take under 10 seconds
+     autoscale:
+       min: 2
+       max: 8
+       scale_up_lag: 60
+       scale_down_lag: 10
      session: *sql
      twitter_api: *twitter
      tweet_id_queue: *tweet_id_queue
 
+   queue_collector:
+     type: custom
+     target: skrode.redis.workqueue:collect_queues
+     queues:
+       - *twitter_user_id_queue
+       - *tweet_id_queue
+     interval: 60
+
    workers:
      - twitter_home_timeline
      - twitter_user_ids
      - twitter_empty_tweets
      - twitter_tweet_ids
+     - queue_collector
 
 """
 
 import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from heapq import heappop, heappush
 from importlib import import_module
 import logging
 from multiprocessing import Process
 import os
-from queue import Empty, Queue
 import signal
 import sys
 import threading
 import time
 
+from skrode.autoscale import Autoscaler
 from skrode.config import Config
+from skrode.errors import BatchError
+from skrode.redis.workqueue import PrefetchingQueue
+from skrode.supervisor import CircuitBreaker
 
 import colorlog
+from sqlalchemy.orm import Session, sessionmaker
 
 
 log = None
@@ -164,23 +259,315 @@ def worker(name):
   return _inner
 
 
+def _thread_kwargs(kwargs):
+  """A copy of a target's kwargs for use by one thread or task, with a new session in place of each
+  SQL session, since sessions mustn't be shared between concurrent calls.
+  """
+
+  return {key: sessionmaker(bind=value.get_bind())() if isinstance(value, Session) else value
+          for key, value in kwargs.items()}
+
+
+def _close_sessions(thread_kwargs):
+  """Close the SQL sessions of every thread's or task's kwargs, once they are done."""
+
+  for kwargs in thread_kwargs:
+    for value in kwargs.values():
+      if isinstance(value, Session):
+        value.close()
+
+
+def _map_concurrently(event, target, source, sleep, concurrency, kwargs):
+  """Map the target over the source on a pool of `concurrency` threads, each with its own kwargs.
+
+  An item is only claimed once a thread is free to process it. A target failing aborts its item
+  and rolls back its thread's sessions, but doesn't stop the worker. The threads' sessions are
+  closed once the pool has shut down.
+
+  Items of a source which routes values by key (see
+  :py:class:`skrode.redis.workqueue.PartitionedWorkQueue`) are processed one key at a time: an item
+  claimed while another of its key is in hand waits to be processed after it, by the same thread.
+  """
+
+  local = threading.local()
+  slots = threading.BoundedSemaphore(concurrency)
+  thread_kwargs = []
+  routing_key = getattr(source, "routing_key", None)
+  # The items waiting on each key with an item in hand
+  waiting = {}
+  waiting_lock = threading.Lock()
+
+  def _process(item):
+    if not hasattr(local, "kwargs"):
+      local.kwargs = _thread_kwargs(kwargs)
+      thread_kwargs.append(local.kwargs)
+    try:
+      with item as item_contents:
+        target(item_contents, **local.kwargs)
+    except Exception:
+      log.exception("Failed to process an item from %r", source)
+      for value in local.kwargs.values():
+        if isinstance(value, Session):
+          value.rollback()
+    finally:
+      slots.release()
+
+  def _process_key(key, item):
+    while item is not None:
+      _process(item)
+      with waiting_lock:
+        item = waiting[key].popleft() if waiting[key] else None
+        if item is None:
+          del waiting[key]
+
+  def _submit(executor, item):
+    if routing_key is None:
+      executor.submit(_process, item)
+      return
+
+    try:
+      key = routing_key(item.value)
+    except Exception:
+      log.exception("Failed to route an item from %r", source)
+      item.abort()
+      slots.release()
+      return
+    with waiting_lock:
+      if key in waiting:
+        waiting[key].append(item)
+        return
+      waiting[key] = deque()
+    executor.submit(_process_key, key, item)
+
+  try:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      while not event.is_set():
+        # Waiting on a slot costs nothing, so check for shutdown every second
+        if not slots.acquire(timeout=1):
+          continue
+        item = source.get(timeout=sleep, cancel=event)
+        if item is None:
+          slots.release()
+        else:
+          _submit(executor, item)
+  finally:
+    _close_sessions(thread_kwargs)
+
+
 @worker("map")
-def map_worker(event, target, source, type=None, sleep=1, **kwargs):
+def map_worker(event, target, source, type=None, sleep=60, prefetch=None, concurrency=1,
+               **kwargs):
   """A worker which just maps over the items on a queue.
 
-  Tries to read an item from the work queue, processes it if there is one, otherwise waits 5s.
+  Blocks for up to `sleep` seconds waiting for an item to be put on the work queue, processing it if
+  there is one. An idle worker makes no calls against Redis while it waits, and wakes at once to
+  shut down.
+
+  With `prefetch`, up to that many items are claimed ahead in the background, so that the next item
+  is ready as soon as the last is done.
+
+  With a `concurrency` above 1, up to that many items are processed at once on a pool of threads.
+  Each thread has its own SQL session in place of any session given to the target. Items of a
+  partitioned queue are still processed one routing key at a time.
+
+  A target raising aborts its item either way. Processing serially the error then stops the worker,
+  to be restarted by the topology, whereas processing concurrently it is logged and the worker
+  carries on, so that one failure doesn't throw away the work the other threads have in flight.
+  """
+
+  target = _import(target)
+  if prefetch:
+    source = PrefetchingQueue(source, size=prefetch, poll=sleep)
+
+  try:
+    if concurrency > 1:
+      _map_concurrently(event, target, source, sleep, concurrency, kwargs)
+      return
+
+    while not event.is_set():
+      item = source.get(timeout=sleep, cancel=event)
+      if item is not None:
+        with item as item_contents:
+          target(item_contents, **kwargs)
+  finally:
+    if prefetch:
+      source.close()
+
+
+def _gather(event, source, batch_size, max_wait, sleep):
+  """Claim a batch of up to `batch_size` items.
+
+  Waits for up to `sleep` seconds for a first item, and then for up to `max_wait` seconds more for
+  the batch to fill, or until the `event` is set. Returns a possibly empty list of items.
+  """
+
+  items = source.get_many(batch_size)
+  if not items:
+    item = source.get(timeout=sleep, cancel=event)
+    if item is None:
+      return []
+    items = [item]
+
+  deadline = time.time() + max_wait
+  while len(items) < batch_size:
+    items.extend(source.get_many(batch_size - len(items)))
+    remaining = deadline - time.time()
+    if len(items) >= batch_size or remaining <= 0:
+      break
+    item = source.get(timeout=remaining, cancel=event)
+    if item is None:
+      break
+    items.append(item)
+
+  return items
+
+
+@worker("batch")
+def batch_worker(event, target, source, type=None, sleep=1, batch_size=100, max_wait_ms=1000,
+                 **kwargs):
+  """A worker which maps over batches of the items on a queue.
+
+  Claims up to `batch_size` items, waiting up to `max_wait_ms` milliseconds for a partial batch to
+  fill, and calls the target once with the list of their values.
+
+  The batch is completed if the target returns and aborted if it raises. A target which raises a
+  :py:class:`skrode.errors.BatchError` instead aborts only the items it lists as failed, completing
+  the rest. Items whose values can't be decoded are aborted before the target is called.
   """
 
   target = _import(target)
 
   while not event.is_set():
-    item = source.get()
-    if item is not None:
-      with item as item_contents:
-        target(item_contents, **kwargs)
+    # An item which can't be decoded is aborted alone, so that it doesn't fail the whole batch
+    items, values = _gather(event, source, batch_size, max_wait_ms / 1000.0, sleep), []
+    for item in list(items):
+      try:
+        values.append(item.value)
+      except Exception:
+        log.exception("Failed to decode an item from %r", source)
+        items.remove(item)
+        item.abort()
+    if not items:
+      continue
+
+    try:
+      target(values, **kwargs)
+    except BatchError as e:
+      failed = set(e.failed)
+      log.warning("Failed to process %d of a batch of %d items from %r",
+                  len(failed), len(items), source)
+      for pos, item in enumerate(items):
+        if pos in failed:
+          item.abort()
+        else:
+          item.complete()
+    except BaseException:
+      # Whatever stops the target, even an interrupt, the batch is given back rather than leased
+      for item in items:
+        item.abort()
+      raise
     else:
-      # FIXME: make this a configurable strategy
-      time.sleep(sleep)
+      for item in items:
+        item.complete()
+
+
+# Queue calls are single short round trips, so a few threads keep up with many items in flight.
+_QUEUE_IO_THREADS = 4
+
+
+async def _async_map(event, target, source, sleep, inflight, threads, kwargs):
+  """Map the target over the source with up to `inflight` items in flight at once.
+
+  The source is a blocking queue, so claims, completions and aborts run on a small thread pool of
+  their own, which targets can't starve. Blocking targets run on a pool of `threads` threads (each
+  with its own kwargs, see `_thread_kwargs`), and no more items are claimed than there are threads
+  free to process them, so none wait out their leases for a thread. Each coroutine target call has
+  its own kwargs instead. Items are claimed in batches as slots come free.
+  """
+
+  loop = asyncio.get_event_loop()
+  is_coroutine = asyncio.iscoroutinefunction(target)
+  queue_io = ThreadPoolExecutor(max_workers=_QUEUE_IO_THREADS)
+  executor = None if is_coroutine else ThreadPoolExecutor(max_workers=threads)
+  local = threading.local()
+  thread_kwargs = []
+  slots = asyncio.Semaphore(inflight if is_coroutine else min(inflight, threads))
+  tasks = set()
+
+  def _call(item):
+    if not hasattr(local, "kwargs"):
+      local.kwargs = _thread_kwargs(kwargs)
+      thread_kwargs.append(local.kwargs)
+    return target(item.value, **local.kwargs)
+
+  async def _await(item):
+    task_kwargs = _thread_kwargs(kwargs)
+    try:
+      await target(item.value, **task_kwargs)
+    finally:
+      _close_sessions([task_kwargs])
+
+  async def _process(item):
+    try:
+      if is_coroutine:
+        await _await(item)
+      else:
+        await loop.run_in_executor(executor, _call, item)
+    except Exception:
+      log.exception("Failed to process an item from %r", source)
+      await loop.run_in_executor(queue_io, item.abort)
+    else:
+      await loop.run_in_executor(queue_io, item.complete)
+    finally:
+      slots.release()
+
+  try:
+    while not event.is_set():
+      await slots.acquire()
+      free = 1
+      while not slots.locked():
+        await slots.acquire()
+        free += 1
+
+      items = await loop.run_in_executor(queue_io, source.get_many, free)
+      if not items:
+        item = await loop.run_in_executor(queue_io, partial(source.get, sleep, cancel=event))
+        items = [item] if item is not None else []
+
+      for _ in range(free - len(items)):
+        slots.release()
+      for item in items:
+        task = loop.create_task(_process(item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+      await asyncio.wait(tasks)
+  finally:
+    if executor is not None:
+      executor.shutdown(wait=True)
+    queue_io.shutdown(wait=True)
+    _close_sessions(thread_kwargs)
+
+
+@worker("async_map")
+def async_map_worker(event, target, source, type=None, sleep=1, inflight=64, threads=16,
+                     **kwargs):
+  """A worker which maps over the items on a queue with many items in flight at once.
+
+  Coroutine targets are awaited on an event loop, with up to `inflight` items being processed at
+  once. Blocking targets are run on a pool of `threads` threads instead, with up to the lesser of
+  `inflight` and `threads` items in flight. Items are completed when their target returns, and
+  aborted if it raises. As with concurrent map workers, each thread or coroutine call has its own
+  SQL session.
+  """
+
+  target = _import(target)
+  loop = asyncio.new_event_loop()
+  try:
+    loop.run_until_complete(_async_map(event, target, source, sleep, inflight, threads, kwargs))
+  finally:
+    loop.close()
 
 
 @worker("custom")
@@ -193,6 +580,12 @@ def custom_worker(event, target, type=None, **kwargs):
   target(event=event, **kwargs)
 
 
+def _describe_status(status):
+  if os.WIFSIGNALED(status):
+    return "was killed by signal %d" % (os.WTERMSIG(status),)
+  return "exited with status %d" % (os.WEXITSTATUS(status),)
+
+
 def mk_sigint_event():
   event = threading.Event()
 
@@ -220,7 +613,9 @@ def worker(opts, target_name):
   # Provide a graceful shutdown signal handler
   event = mk_sigint_event()
 
-  target = config.get(target_name).dict()
+  target = dict(config.get(target_name).dict())
+  target.pop("autoscale", None)
+  target.pop("restart", None)
   log.info("Booting worker %r", target_name)
   # We're gonna load up a single worker, and start running it.
   return WORKER_REGISTRY.get(target.get("type"))(event, **target)
@@ -241,21 +636,45 @@ def main(opts):
   config = Config(config=opts.config)
 
   children = {}
-  restarts = Queue()
-
-  # Populate the restart queue
+  retiring = set()
+  # Exits are recorded by the SIGCHLD handler and handled by the main loop. A deque, since its
+  # appends and pops need no locks which the handler could interrupt.
+  exited = deque()
+  # A heap of the times at which workers are due to be (re)started
+  restarts = []
+  autoscalers = {}
+  breakers = {}
+
+  # Populate the restart queue, with the minimum replicas of autoscaled workers
   for worker_name in config.get("workers"):
-    restarts.put(worker_name)
+    if worker_name not in breakers:
+      restart = config.get(worker_name).get("restart")
+      breakers[worker_name] = CircuitBreaker(worker_name,
+                                             **(restart.dict() if restart is not None else {}))
+
+    autoscale = config.get(worker_name).get("autoscale")
+    if autoscale is None:
+      heappush(restarts, (0, worker_name))
+    elif worker_name not in autoscalers:
+      autoscalers[worker_name] = Autoscaler(worker_name, config.get(worker_name).get("source"),
+                                            **autoscale.dict())
+      for _ in range(autoscalers[worker_name].replicas):
+        heappush(restarts, (0, worker_name))
+
+  def _replicas(worker_name):
+    return [pid for pid, job in list(children.items())
+            if job == worker_name and pid not in retiring]
 
   def _chld(sig, frame):
-    pid, status = os.waitpid(-1, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
-    if os.WIFCONTINUED(status) or os.WIFSTOPPED(status) or pid == 0:
-      return
-    elif os.WIFEXITED(status):
-      job = children[pid]
-      restarts.put(job)
-      log.warn("Subprocess %d exited, job %r queued for restart", pid, job)
-      del children[pid]
+    # Signals coalesce, so one SIGCHLD may stand for any number of exits
+    while True:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        return
+      if pid == 0:
+        return
+      exited.append((pid, status, time.time()))
 
   # When a child dies, restart it
   signal.signal(signal.SIGCHLD, _chld)
@@ -263,20 +682,72 @@ def main(opts):
   # When we get a SIGUSR1, reboot the entire system
   signal.signal(signal.SIGUSR1, reboot)
 
+  # When we get a SIGUSR2, report the state of every worker
+  def _report(sig, frame):
+    for worker_name, breaker in sorted(breakers.items()):
+      log.info("Worker %r: %d replicas, %s", worker_name, len(_replicas(worker_name)), breaker)
+
+  signal.signal(signal.SIGUSR2, _report)
+
   event = mk_sigint_event()
   while not event.is_set():
-    # Restart all the dead children..
-    while not event.is_set():
-      try:
-        worker_name = restarts.get_nowait()
-      except Empty:
-        break
+    now = time.time()
+
+    # Reap the dead children, queueing them for restart after their worker's backoff
+    while exited:
+      pid, status, when = exited.popleft()
+      job = children.pop(pid, None)
+      if job is None:
+        continue
+      elif pid in retiring:
+        retiring.discard(pid)
+        breakers[job].retired(pid)
+        log.info("Subprocess %d of job %r retired", pid, job)
+        continue
+
+      delay = breakers[job].exited(pid, when)
+      heappush(restarts, (when + delay, job))
+      log.warning("Subprocess %d %s, job %r queued for restart in %ds",
+                  pid, _describe_status(status), job, delay)
+
+    for breaker in breakers.values():
+      breaker.poll(now)
+
+    # Restart all the dead children which are due..
+    held = []
+    while restarts and restarts[0][0] <= now and not event.is_set():
+      _, worker_name = heappop(restarts)
+
+      # Scaling down may have left a replica queued for restart which is no longer wanted
+      if (worker_name in autoscalers and
+          len(_replicas(worker_name)) >= autoscalers[worker_name].replicas):
+        continue
+
+      # An open or half-open circuit holds restarts, bar the one trial replica
+      until = breakers[worker_name].held_until(now)
+      if until is not None:
+        held.append((max(until, now + 1), worker_name))
+        continue
 
       ps = Process(target=worker, args=(opts, worker_name))
       ps.start()
       children[ps.pid] = worker_name
-
-    time.sleep(5)
+      breakers[worker_name].started(ps.pid, now)
+    for restart in held:
+      heappush(restarts, restart)
+
+    # Scale autoscaled workers, retiring replicas by SIGINT so they finish their work in hand
+    for worker_name, autoscaler in autoscalers.items():
+      change = autoscaler.sample(now)
+      if change > 0:
+        heappush(restarts, (now, worker_name))
+      elif change < 0:
+        replicas = _replicas(worker_name)
+        if replicas:
+          retiring.add(replicas[-1])
+          os.kill(replicas[-1], signal.SIGINT)
+
+    time.sleep(min(5, max(restarts[0][0] - time.time(), 0.1)) if restarts else 5)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+"""
+Scaling the replicas of a worker to the lag of its source queue.
+"""
+
+import logging
+
+
+log = logging.getLogger(__name__)
+
+# Only the implicit consumers of a queue are counted, as it is their backlog which len() measures.
+_IMPLICIT_CONSUMER = "/implicit_consumer"
+
+
+def _dequeue_rate(stats):
+  """The rate in items per second over the last minute at which the implicit consumer in the stats
+  of a queue (or a list or dict of them, for partitioned and priority queues) dequeued, or None if
+  the queue doesn't track dequeue rates.
+  """
+
+  if isinstance(stats, dict) and "length" not in stats:
+    stats = list(stats.values())
+  if isinstance(stats, list):
+    rates = [_dequeue_rate(s) for s in stats]
+    return None if None in rates else sum(rates)
+  elif "consumers" not in stats:
+    return None
+  return sum(consumer["dequeue_rate"][60] for consumer_id, consumer in stats["consumers"].items()
+             if consumer_id.endswith(_IMPLICIT_CONSUMER))
+
+
+class Autoscaler(object):
+  """Decides how many replicas of a worker to run from the lag of its source queue.
+
+  The lag is how long the queue's backlog would take to drain at its current dequeue rate. A replica
+  is added once the lag has been above `scale_up_lag` seconds for `samples` samples in a row, and
+  one is retired once the lag has been below `scale_down_lag` seconds for as long, keeping between
+  `min` and `max` replicas. The gap between the thresholds and the run of samples needed after
+  every change keep the replica count from flapping.
+
+  A backlog which hasn't been dequeued from yet has no lag, and is skipped rather than sampled.
+  Likewise queues which don't track dequeue rates, such as stream queues, are never sampled, so
+  their workers stay at `min` replicas.
+  """
+
+  def __init__(self, name, source, min=1, max=1, scale_up_lag=60, scale_down_lag=10, samples=3,
+               interval=30):
+    assert 0 < min <= max
+    assert scale_down_lag < scale_up_lag
+
+    self.name = name
+    self.replicas = min
+    self._source = source
+    self._min = min
+    self._max = max
+    self._scale_up_lag = scale_up_lag
+    self._scale_down_lag = scale_down_lag
+    self._samples = samples
+    self._interval = interval
+    self._next_sample = 0
+    self._warned = False
+    self._above = 0
+    self._below = 0
+
+  def lag(self):
+    """The lag of the source queue in seconds, or None if it has a backlog but no dequeue rate."""
+
+    backlog = len(self._source)
+    if not backlog:
+      return 0.0
+
+    stats = getattr(self._source, "stats", None)
+    rate = _dequeue_rate(stats()) if stats is not None else None
+    if rate is None and not self._warned:
+      log.warning("Can't autoscale worker %r, as its source %r doesn't track dequeue rates",
+                  self.name, self._source)
+      self._warned = True
+    if not rate:
+      return None
+    return backlog / rate
+
+  def sample(self, now):
+    """Sample the lag if a sample is due, returning the change to make in the number of replicas."""
+
+    if now < self._next_sample:
+      return 0
+    self._next_sample = now + self._interval
+
+    try:
+      lag = self.lag()
+    except Exception:
+      log.exception("Failed to sample the lag of worker %r", self.name)
+      return 0
+    if lag is None:
+      return 0
+
+    self._above = self._above + 1 if lag > self._scale_up_lag else 0
+    self._below = self._below + 1 if lag < self._scale_down_lag else 0
+
+    change = 0
+    if self._above >= self._samples and self.replicas < self._max:
+      change = 1
+    elif self._below >= self._samples and self.replicas > self._min:
+      change = -1
+
+    if change:
+      self._above = self._below = 0
+      self.replicas += change
+      log.info("Scaling worker %r to %d replicas at a lag of %.1fs",
+               self.name, self.replicas, lag)
+    return change
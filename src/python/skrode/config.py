@@ -4,10 +4,14 @@ The BBDB config
 
 from __future__ import absolute_import
 
-import json
+from importlib import import_module
 import types
 
-from skrode.redis.workqueue import WorkQueue
+from skrode.local.workqueue import WorkQueue as LocalWorkQueue
+from skrode.redis.cluster import RedisCluster
+from skrode.redis.codec import make_codec
+from skrode.redis.stream import WorkQueue as StreamWorkQueue
+from skrode.redis.workqueue import PartitionedWorkQueue, PriorityWorkQueue, WorkQueue
 from skrode.sql import make_engine_session_factory
 from skrode.sql import make_uri as make_sql_uri
 
@@ -18,7 +22,7 @@ import yaml
 
 def make_proxy_ctor(ctor, **more):
   def _from_yaml(loader, node):
-    d = loader.construct_mapping(node)
+    d = loader.construct_mapping(node, deep=True)
     d.update(more)
     return ctor(**d)
 
@@ -30,16 +34,48 @@ def _make_sql_session(**kwargs):
   return sessionmaker()
 
 
-def _decode_and_load(text):
-  if isinstance(text, bytes):
-    text = text.decode("utf-8")
-  return json.loads(text)
+def _make_queue(codec="json", compress=False, **kwargs):
+  encoder, decoder = make_codec(codec, compress=compress)
+  return WorkQueue(encoder=encoder, decoder=decoder, **kwargs)
+
+
+def _make_priority_queue(codec="json", compress=False, **kwargs):
+  encoder, decoder = make_codec(codec, compress=compress)
+  return PriorityWorkQueue(encoder=encoder, decoder=decoder, **kwargs)
+
+
+def _make_partitioned_queue(codec="json", compress=False, route=None, **kwargs):
+  encoder, decoder = make_codec(codec, compress=compress)
+  if route is not None:
+    # Routing functions are named by "module:function" path
+    module_name, member_name = route.split(":")
+    route = getattr(import_module(module_name), member_name)
+  return PartitionedWorkQueue(encoder=encoder, decoder=decoder, route=route, **kwargs)
+
+
+def _make_stream_queue(codec="json", compress=False, **kwargs):
+  encoder, decoder = make_codec(codec, compress=compress)
+  return StreamWorkQueue(encoder=encoder, decoder=decoder, **kwargs)
+
+
+def _queue_lane(queue, lane):
+  return queue.lane(lane)
+
+
+def _make_local_queue(codec="json", compress=False, **kwargs):
+  encoder, decoder = make_codec(codec, compress=compress)
+  return LocalWorkQueue(encoder=encoder, decoder=decoder, **kwargs)
 
 
 yaml.SafeLoader.add_constructor('!skrode/redis', make_proxy_ctor(redis.StrictRedis))
-yaml.SafeLoader.add_constructor('!skrode/queue', make_proxy_ctor(WorkQueue,
-                                                                 encoder=json.dumps,
-                                                                 decoder=_decode_and_load))
+yaml.SafeLoader.add_constructor('!skrode/redis_cluster', make_proxy_ctor(RedisCluster))
+yaml.SafeLoader.add_constructor('!skrode/queue', make_proxy_ctor(_make_queue))
+yaml.SafeLoader.add_constructor('!skrode/priority_queue', make_proxy_ctor(_make_priority_queue))
+yaml.SafeLoader.add_constructor('!skrode/partitioned_queue',
+                                make_proxy_ctor(_make_partitioned_queue))
+yaml.SafeLoader.add_constructor('!skrode/stream_queue', make_proxy_ctor(_make_stream_queue))
+yaml.SafeLoader.add_constructor('!skrode/lane', make_proxy_ctor(_queue_lane))
+yaml.SafeLoader.add_constructor('!skrode/local_queue', make_proxy_ctor(_make_local_queue))
 yaml.SafeLoader.add_constructor('!skrode/twitter', make_proxy_ctor(Api))
 yaml.SafeLoader.add_constructor('!skrode/sql', make_proxy_ctor(_make_sql_session))
 
@@ -0,0 +1,15 @@
+"""
+Errors shared between workers and their targets, whatever queue backend feeds them.
+"""
+
+
+class BatchError(Exception):
+  """Raised by a target processing a batch of work items to report that only some of them failed.
+
+  `failed` holds the positions in the batch of the items which failed. Those items are aborted and
+  the rest of the batch is completed.
+  """
+
+  def __init__(self, failed, message=None):
+    super(BatchError, self).__init__(message or "%d items of the batch failed" % (len(failed),))
+    self.failed = list(failed)
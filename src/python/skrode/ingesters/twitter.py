@@ -9,6 +9,7 @@ import logging
 import signal
 import time
 
+from skrode.errors import BatchError
 from skrode.schema import Account, Post, PostDistribution, PostRelationship
 from skrode.services import twitter as bt
 
@@ -38,6 +39,33 @@ def ingest_user(user_id, session, twitter_api):
     log.debug("Already had user %s", u)
 
 
+def ingest_users(user_ids, session, twitter_api):
+  """Ingest a batch of users by ID with a single users/lookup call, for the `batch` worker.
+
+  Raises a BatchError listing the IDs which Twitter didn't return, such as deleted or suspended
+  users.
+  """
+
+  external_ids = [bt.twitter_external_user_id(id) for id in user_ids]
+  known = {external_id for external_id, in
+           session.query(Account.external_id)
+                  .filter(Account.external_id.in_(external_ids))}
+  wanted = [id for id, external_id in zip(user_ids, external_ids) if external_id not in known]
+  if not wanted:
+    log.debug("Already had all %d users", len(user_ids))
+    return
+
+  found = set()
+  for user in twitter_api.UsersLookup(user_id=wanted):
+    log.info("Created user %s", bt.insert_user(session, user))
+    found.add(bt.twitter_external_user_id(user.id))
+
+  missing = [pos for pos, external_id in enumerate(external_ids)
+             if external_id not in known and external_id not in found]
+  if missing:
+    raise BatchError(missing, "Twitter returned no user for %d IDs" % (len(missing),))
+
+
 def ingest_user_object(user, session):
   u = have_user(session, user.id)
   if u is None:
@@ -76,6 +104,9 @@ def ingest_tweet(tweet, session, twitter_api, tweet_id_queue):
     if not flag:
       log.info(t)
 
+    # Tweet IDs discovered while ingesting this tweet, enqueued together once we're done.
+    tweet_ids = []
+
     if tweet.in_reply_to_status_id:
       # This tweet is a reply. It links to some other tweet. Or possibly tweets depending on the
       # link content which may link many statuses. However Twitter only considers one status to
@@ -83,8 +114,7 @@ def ingest_tweet(tweet, session, twitter_api, tweet_id_queue):
       # inserting its parent post(s) (recursively!)
       thread_id = str(tweet.in_reply_to_status_id)
       if not have_tweet(session, thread_id):
-        tweet_id_queue.put(thread_id)
-        pass
+        tweet_ids.append(thread_id)
 
     if tweet.quoted_status:
       # This is a quote tweet (possibly subtweet or snarky reply, quote tweets have different
@@ -94,8 +124,10 @@ def ingest_tweet(tweet, session, twitter_api, tweet_id_queue):
     for url in tweet.urls or []:
       tweet_id = bt.tweet_id_from_url(url.expanded_url)
       if tweet_id and not have_tweet(session, tweet_id):
-        tweet_id_queue.put(tweet_id)
-        pass
+        tweet_ids.append(tweet_id)
+
+    if tweet_ids:
+      tweet_id_queue.put_many(tweet_ids)
 
     for user in tweet.user_mentions or []:
       if not isinstance(user, User):
@@ -174,8 +206,7 @@ def _ingest_event(stream_event, session, twitter_api, tweet_id_queue, user_queue
     ingest_tweet(stream_event, session, twitter_api, tweet_id_queue)
 
   elif "friends" in stream_event:
-    for friend in stream_event.get("friends"):
-      user_queue.put(str(friend))
+    user_queue.put_many([str(friend) for friend in stream_event.get("friends")])
 
   else:
     blob = json.dumps(stream_event)
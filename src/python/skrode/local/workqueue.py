@@ -0,0 +1,384 @@
+"""
+A simple queue shared between the processes of a single host, backed by a memory-mapped file.
+
+Provides the same `Producer`, `Consumer` and `WorkQueue` API as :py:mod:`skrode.redis.workqueue`,
+for topologies whose workers all run on one box and so needn't pay for a network hop to Redis.
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import fcntl
+from hashlib import sha1
+import mmap
+import os
+import struct
+import threading
+from time import sleep, time
+
+
+# The header is the magic, the capacity of the ring in bytes, the total bytes ever written to the
+# ring and the total records ever written, followed by consumer slots. Each slot is the hash of the
+# consumer's ID (0 for a free slot), the total bytes the consumer has read and the total records it
+# has read. Offsets into the ring are those totals modulo the capacity.
+_MAGIC = b"SKRODEQ1"
+_HEADER = struct.Struct("<8sQQQ")
+_SLOT = struct.Struct("<QQQ")
+_SLOTS = 32
+_DATA_OFFSET = 4096
+_RECORD = struct.Struct("<I")
+
+assert _HEADER.size + _SLOTS * _SLOT.size <= _DATA_OFFSET
+
+
+class QueueFull(Exception):
+  """Raised when a record cannot fit in the ring even once every consumer has caught up."""
+
+
+class _Ring(object):
+  """Helper class.
+
+  An append only ring buffer of records in a memory-mapped file, with a read cursor per consumer.
+  Every operation holds both a lock on the file, excluding other processes, and a thread lock, since
+  file locks don't exclude other threads of the same process.
+
+  Space in the ring is reclaimed once every registered consumer has read past it, so a consumer
+  which stops reading eventually blocks producers.
+  """
+
+  def __init__(self, path, capacity):
+    self._path = path
+    self._lock = threading.Lock()
+    self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    with self._file_lock():
+      if os.fstat(self._fd).st_size == 0:
+        os.ftruncate(self._fd, _DATA_OFFSET + capacity)
+        os.pwrite(self._fd, _HEADER.pack(_MAGIC, capacity, 0, 0), 0)
+
+    self._map = mmap.mmap(self._fd, 0)
+    magic, self._capacity, _, _ = _HEADER.unpack_from(self._map, 0)
+    if magic != _MAGIC:
+      raise ValueError("%r is not a queue file" % (path,))
+
+  @contextmanager
+  def _file_lock(self):
+    fcntl.flock(self._fd, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+  @contextmanager
+  def _locked(self):
+    with self._lock:
+      with self._file_lock():
+        yield
+
+  def _head(self):
+    _, _, written, records = _HEADER.unpack_from(self._map, 0)
+    return written, records
+
+  def _slot(self, slot):
+    return _SLOT.unpack_from(self._map, _HEADER.size + slot * _SLOT.size)
+
+  def _set_slot(self, slot, id_hash, read, records):
+    _SLOT.pack_into(self._map, _HEADER.size + slot * _SLOT.size, id_hash, read, records)
+
+  def register(self, consumer_id):
+    """Get the slot of the named consumer, allocating one starting at the head of the ring if the
+    consumer is new.
+    """
+
+    id_hash = struct.unpack("<Q", sha1(consumer_id.encode("utf-8")).digest()[:8])[0] or 1
+
+    with self._locked():
+      free = None
+      for slot in range(_SLOTS):
+        slot_hash, _, _ = self._slot(slot)
+        if slot_hash == id_hash:
+          return slot
+        elif slot_hash == 0 and free is None:
+          free = slot
+
+      if free is None:
+        raise ValueError("%r has no free consumer slots" % (self._path,))
+
+      written, records = self._head()
+      self._set_slot(free, id_hash, written, records)
+      return free
+
+  def unregister(self, slot):
+    with self._locked():
+      self._set_slot(slot, 0, 0, 0)
+
+  def _copy_in(self, offset, blob):
+    offset = offset % self._capacity
+    split = min(len(blob), self._capacity - offset)
+    self._map[_DATA_OFFSET + offset:_DATA_OFFSET + offset + split] = blob[:split]
+    self._map[_DATA_OFFSET:_DATA_OFFSET + len(blob) - split] = blob[split:]
+
+  def _copy_out(self, offset, length):
+    offset = offset % self._capacity
+    split = min(length, self._capacity - offset)
+    return (self._map[_DATA_OFFSET + offset:_DATA_OFFSET + offset + split] +
+            self._map[_DATA_OFFSET:_DATA_OFFSET + length - split])
+
+  def append(self, blobs):
+    """Append all the blobs to the ring, returning the record number of the first, or None if there
+    isn't room for them yet.
+    """
+
+    size = self.size_of(blobs)
+    if size > self._capacity:
+      raise QueueFull("%d bytes of records exceed the %d byte ring" % (size, self._capacity))
+
+    with self._locked():
+      if self._free() < size:
+        return None
+      written, records = self._head()
+
+      offset = written
+      for blob in blobs:
+        self._copy_in(offset, _RECORD.pack(len(blob)))
+        self._copy_in(offset + _RECORD.size, blob)
+        offset += _RECORD.size + len(blob)
+
+      _HEADER.pack_into(self._map, 0, _MAGIC, self._capacity, offset, records + len(blobs))
+      return records
+
+  @staticmethod
+  def size_of(blobs):
+    """The bytes the blobs take up in the ring as records."""
+
+    return sum(_RECORD.size + len(blob) for blob in blobs)
+
+  def _free(self):
+    written, _ = self._head()
+    low = min([read for id_hash, read, _ in map(self._slot, range(_SLOTS)) if id_hash] or
+              [written])
+    return self._capacity - (written - low)
+
+  def has_room(self, size):
+    """Whether `size` bytes of records would fit in the ring.
+
+    Reads without locking, so is only a hint for deciding whether to wait.
+    """
+
+    return self._free() >= size
+
+  def read(self, slot, n):
+    """Read up to `n` records for the consumer in the given slot, advancing its cursor."""
+
+    with self._locked():
+      written, records = self._head()
+      id_hash, read, done = self._slot(slot)
+
+      blobs = []
+      while read < written and len(blobs) < n:
+        length, = _RECORD.unpack(self._copy_out(read, _RECORD.size))
+        blobs.append(self._copy_out(read + _RECORD.size, length))
+        read += _RECORD.size + length
+
+      self._set_slot(slot, id_hash, read, done + len(blobs))
+      return blobs
+
+  def pending(self, slot):
+    """The number of records the consumer in the given slot has yet to read.
+
+    Reads without locking, so is only a hint for deciding whether to wait.
+    """
+
+    _, records = self._head()
+    return records - self._slot(slot)[2]
+
+  def __len__(self):
+    return self._head()[1]
+
+  def close(self):
+    self._map.close()
+    os.close(self._fd)
+
+
+def _wait(predicate, timeout, cancel=None):
+  """Poll the predicate, backing off from 1ms to 50ms, until it holds or the timeout passes (or the
+  `cancel` event is set).
+  """
+
+  deadline = time() + timeout
+  delay = 0.001
+  while not predicate():
+    remaining = deadline - time()
+    if remaining <= 0 or (cancel is not None and cancel.is_set()):
+      return False
+    sleep(min(delay, remaining))
+    delay = min(delay * 2, 0.05)
+  return True
+
+
+class WorkItem(object):
+  """
+  Helper class to WorkQueue.
+
+  Represents a unit of work to be done as returned by `WorkQueue.get`, with the same interface as
+  :py:class:`skrode.redis.workqueue.WorkItem`.
+
+  Reading an item removes it from the ring, so completing an item does nothing, and aborting an item
+  queues it for redelivery by the same consumer in this process. An item claimed by a process which
+  dies is lost.
+  """
+
+  def __init__(self, consumer, raw):
+    self._consumer = consumer
+    self._raw = raw
+
+  @property
+  def value(self):
+    return self._consumer._decoder(self._raw)
+
+  def complete(self):
+    pass
+
+  def abort(self):
+    """Admit a failure to process this work item and put it back on the queue."""
+
+    self._consumer._retries.append(self._raw)
+
+  def extend(self):
+    pass
+
+  def release(self):
+    """Give up this work item unprocessed, to be redelivered."""
+
+    self._consumer._retries.appendleft(self._raw)
+
+  def __enter__(self):
+    return self.value
+
+  def __exit__(self, type, value, traceback):
+    if type is None and value is None and traceback is None:
+      self.complete()
+    else:
+      self.abort()
+
+
+class Producer(object):
+  """A helper type which represents a writer to a host local FIFO queue.
+
+  Puts block while the ring is too full to hold the values.
+  """
+
+  def __init__(self, path, encoder=None, capacity=64 * 1024 * 1024):
+    self._ring = _Ring(path, capacity)
+    self._encoder = encoder or (lambda x: x)
+
+  def __len__(self):
+    return len(self._ring)
+
+  def put(self, value):
+    return self.put_many([value])
+
+  def put_many(self, values):
+    """Enqueue all of the given values in order, returning the record number of the first."""
+
+    blobs = []
+    for value in values:
+      blob = self._encoder(value)
+      blobs.append(blob.encode("utf-8") if not isinstance(blob, bytes) else blob)
+
+    size = _Ring.size_of(blobs)
+    while True:
+      idx = self._ring.append(blobs)
+      if idx is not None:
+        return idx
+      # Wait for consumers to make room as they wait for producers to fill the ring, without taking
+      # the ring's locks.
+      _wait(lambda: self._ring.has_room(size), 1)
+
+  def close(self):
+    self._ring.close()
+
+
+class Consumer(object):
+  """A helper type which represents a consumer over a host local FIFO queue.
+
+  Each consumer ID has its own durable cursor into the queue, shared by every process consuming as
+  that ID.
+  """
+
+  def __init__(self, path, consumer_id, decoder=None, capacity=64 * 1024 * 1024):
+    self._ring = _Ring(path, capacity)
+    self._slot = self._ring.register(consumer_id)
+    self._decoder = decoder or (lambda x: x)
+    self._retries = deque()
+
+  def __iter__(self):
+    return self
+
+  def __len__(self):
+    return self._ring.pending(self._slot) + len(self._retries)
+
+  def unregister(self):
+    """Stop this consumer from holding back reuse of the ring."""
+
+    self._ring.unregister(self._slot)
+
+  def next(self, timeout=None, cancel=None):
+    """Claim the next WorkItem, raising StopIteration if there is none.
+
+    If a `timeout` in seconds is given and the queue is empty, blocks for up to that long waiting
+    for an item to be put, or until the `cancel` event is set.
+    """
+
+    items = self.next_batch(1)
+    if not items and timeout is not None and _wait(lambda: len(self) > 0, timeout, cancel):
+      items = self.next_batch(1)
+    if not items:
+      raise StopIteration
+    return items[0]
+
+  def next_batch(self, n):
+    """Claim up to `n` WorkItems at once, returning a possibly empty list of them."""
+
+    raws = []
+    while self._retries and len(raws) < n:
+      raws.append(self._retries.popleft())
+    if len(raws) < n:
+      raws.extend(self._ring.read(self._slot, n - len(raws)))
+    return [WorkItem(self, raw) for raw in raws]
+
+  def close(self):
+    self._ring.close()
+
+
+class WorkQueue(object):
+  """The `WorkQueue` API over a host local queue, using an implicit single shared consumer ID across
+  all connected processes.
+  """
+
+  def __init__(self, path, decoder=None, encoder=None, capacity=64 * 1024 * 1024):
+    self._producer = Producer(path, encoder=encoder, capacity=capacity)
+    self._consumer = Consumer(path, "implicit_consumer", decoder=decoder, capacity=capacity)
+
+  def __len__(self):
+    return len(self._consumer)
+
+  def put(self, val):
+    return self._producer.put(val)
+
+  def put_many(self, vals):
+    return self._producer.put_many(vals)
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting for an item to be put, or until
+    the `cancel` event is set.
+    """
+
+    try:
+      return self._consumer.next(timeout=timeout, cancel=cancel)
+    except StopIteration:
+      return None
+
+  def get_many(self, n):
+    return self._consumer.next_batch(n)
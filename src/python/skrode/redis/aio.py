@@ -0,0 +1,294 @@
+"""
+asyncio counterparts of the durable queue in :py:mod:`skrode.redis.workqueue`.
+
+The `Producer`, `Consumer` and `WorkQueue` here use the same keys and run the same scripts as their
+blocking counterparts, so either may be used on either end of the same queue. They take a
+`redis.asyncio` connection, and every method which talks to Redis is a coroutine, so one task can
+keep many claims, puts and acknowledgements in flight over a single connection.
+
+.. code-block:: python
+
+   conn = redis.asyncio.StrictRedis()
+   queue = WorkQueue(conn, "/queue/twitter/user_ids/ready")
+
+   async def work():
+     while True:
+       item = await queue.get(timeout=5)
+       if item is not None:
+         async with item as user_id:
+           await ingest(user_id)
+"""
+
+from __future__ import absolute_import
+
+from random import random
+from time import time
+
+from skrode.redis import workqueue
+
+
+class WorkItem(object):
+  """
+  Helper class to WorkQueue.
+
+  Represents a unit of work to be done as returned by `WorkQueue.get`, as
+  :py:class:`skrode.redis.workqueue.WorkItem` but acknowledged by coroutines. Values are always
+  fetched along with the claim, so the `.value` member needs no I/O.
+
+  When used as an async context manager, the item is completed if the block succeeds and aborted
+  otherwise.
+  """
+
+  def __init__(self, consumer, idx, raw):
+    self._consumer = consumer
+    self._idx = idx
+    self._raw = raw
+
+  @property
+  def value(self):
+    return self._consumer._decoder(self._raw)
+
+  async def complete(self):
+    """Acknowledge that this work item has been processed, releasing its lease for good."""
+
+    leases = self._consumer._leases
+    async with self._consumer._conn.pipeline() as tx:
+      tx.zrem(leases, self._idx)
+      tx.hdel("%s/attempts" % (leases,), self._idx)
+      await tx.execute()
+
+  async def abort(self, retry_in=None):
+    """Admit a failure to process this work item and put it back on the queue. See
+    :py:meth:`skrode.redis.workqueue.WorkItem.abort`.
+    """
+
+    if retry_in is None:
+      retry_in = self._consumer._retry_in
+    if not retry_in:
+      await self._consumer._conn.execute_command("ZADD", self._consumer._leases, "XX", time(),
+                                                 self._idx)
+    else:
+      await self._consumer._list._scripts.abort(
+        keys=[self._consumer._leases],
+        args=[self._idx, time(), retry_in, self._consumer._max_retry_delay, random()])
+
+  async def __aenter__(self):
+    return self.value
+
+  async def __aexit__(self, type, value, traceback):
+    if type is None and value is None and traceback is None:
+      await self.complete()
+    else:
+      await self.abort()
+
+
+class Producer(object):
+  """A writer to a durable FIFO queue. See :py:class:`skrode.redis.workqueue.Producer`."""
+
+  def __init__(self, conn, key, encoder=None, chunk_size=0, dedupe=None):
+    self._conn = conn
+    self._list = workqueue._AppendSeq(conn, key, chunk_size=chunk_size, dedupe=dedupe)
+    self._encoder = encoder or (lambda x: x)
+
+  async def length(self):
+    return int(await self._conn.get(self._list._key) or "0")
+
+  async def put(self, value, delay=None):
+    """Enqueue the value, returning its index (or None if it was a duplicate or delayed)."""
+
+    if delay:
+      await self._list.push_later([self._encoder(value)], delay)
+      return None
+    idx, n = await self._list._push([self._encoder(value)], self._list._dedupe)
+    return idx if n else None
+
+  async def put_many(self, values, delay=None):
+    """Enqueue all of the given values in order, returning the index of the first (or None if they
+    were delayed, or every value was a duplicate).
+    """
+
+    if delay:
+      await self._list.push_later([self._encoder(value) for value in values], delay)
+      return None
+    idx, n = await self._list._push([self._encoder(value) for value in values],
+                                    self._list._dedupe)
+    return idx if n or not values else None
+
+  async def stats(self):
+    """Enqueue statistics of the queue. See `_AppendSeq.stats`."""
+
+    now = time()
+    stats = workqueue._parse_stats(
+      await self._list._scripts.stats(keys=[self._list._key], args=self._list._stats_args(now)),
+      now)
+    del stats["consumers"]
+    return stats
+
+
+class Consumer(workqueue.Consumer):
+  """A consumer over a durable FIFO queue. See :py:class:`skrode.redis.workqueue.Consumer`.
+
+  Registration is deferred to the first claim, since constructors can't await. Claims always fetch
+  their items' values.
+  """
+
+  def __init__(self, conn, key, consumer_id, register=True, **kwargs):
+    super(Consumer, self).__init__(conn, key, consumer_id, register=False, **kwargs)
+    self._register = register
+
+  async def _ensure_registered(self):
+    if self._register:
+      await self._conn.hset("%s/consumers" % (self._list._key,), self._key, self._leases)
+      self._register = False
+
+  async def unregister(self):
+    """Stop this consumer from holding back collection of the queue."""
+
+    await self._conn.hdel("%s/consumers" % (self._list._key,), self._key)
+
+  def __iter__(self):
+    raise TypeError("%r is asynchronous, iterate it with `async for`" % (self,))
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    return await self.next()
+
+  def __len__(self):
+    raise TypeError("%r is asynchronous, use `await length()`" % (self,))
+
+  async def length(self):
+    """The number of items this consumer has yet to claim."""
+
+    max_idx, base, cur_idx = await self._conn.mget(self._list._key,
+                                                   "%s/base" % (self._list._key,), self._key)
+    return max(int(max_idx or "0") - max(int(cur_idx or "0"), int(base or "0")), 0)
+
+  async def stats(self):
+    """Statistics of this consumer, or None if it isn't registered. See `_AppendSeq.stats`."""
+
+    now = time()
+    stats = workqueue._parse_stats(
+      await self._list._scripts.stats(keys=[self._list._key], args=self._list._stats_args(now)),
+      now)
+    return stats["consumers"].get(self._key)
+
+  async def next(self, timeout=None):
+    """Claim the next WorkItem, raising StopAsyncIteration if there is none.
+
+    If a `timeout` in seconds is given and the queue is empty, waits for up to that long to be
+    notified of a put, as :py:meth:`skrode.redis.workqueue.Consumer.next`.
+    """
+
+    deadline = time() + (timeout or 0)
+    while True:
+      items = await self.next_batch(1)
+      if items:
+        return items[0]
+
+      remaining = deadline - time()
+      if remaining <= 0:
+        raise StopAsyncIteration
+
+      if self._pubsub is None:
+        # Subscribe and then check again, so that a put racing the subscription isn't missed.
+        self._pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(*self._channels())
+        continue
+
+      # Wake no later than the next lease expiry or delayed item falling due.
+      async with self._conn.pipeline(transaction=False) as p:
+        for key in self._wake_keys():
+          p.zrange(key, 0, 0, withscores=True)
+        for earliest in await p.execute():
+          for _, expiry in earliest:
+            remaining = max(min(remaining, expiry - time()), 0.01)
+
+      if await self._pubsub.get_message(ignore_subscribe_messages=True,
+                                        timeout=remaining) is not None:
+        while await self._pubsub.get_message(ignore_subscribe_messages=True) is not None:
+          pass
+
+  async def next_batch(self, n):
+    """Claim up to `n` WorkItems at once, returning a possibly empty list of them."""
+
+    await self._ensure_registered()
+    claimed = await self._list._scripts.claim_batch(
+      keys=self._claim_keys(), args=self._list._layout() + self._claim_args() + [n])
+    if claimed is None:
+      return []
+
+    idxs, raws = claimed
+    return [WorkItem(self, idx, raw) for idx, raw in zip(idxs, raws)]
+
+  async def close(self):
+    """Release the notification subscription, if `next` opened one."""
+
+    if self._pubsub is not None:
+      await self._pubsub.aclose()
+      self._pubsub = None
+
+
+class WorkQueue(object):
+  """The `WorkQueue` API with coroutines. See :py:class:`skrode.redis.workqueue.WorkQueue`."""
+
+  def __init__(self, conn, key, inflight=None, decoder=None, encoder=None, retention=None,
+               visibility_timeout=300, chunk_size=0, dedupe=None, retry_in=0,
+               max_retry_delay=3600, max_attempts=None):
+    self._conn = conn
+    self._producer = Producer(conn, key, encoder=encoder, chunk_size=chunk_size, dedupe=dedupe)
+    self._consumer = Consumer(conn, key, "%s/implicit_consumer" % (key,), decoder=decoder,
+                              leases=inflight, visibility_timeout=visibility_timeout,
+                              chunk_size=chunk_size, retry_in=retry_in,
+                              max_retry_delay=max_retry_delay, max_attempts=max_attempts)
+    self._retention = retention if retention is not None else {}
+
+  async def length(self):
+    return await self._consumer.length()
+
+  async def put(self, val, delay=None):
+    return await self._producer.put(val, delay=delay)
+
+  async def put_many(self, vals, delay=None):
+    return await self._producer.put_many(vals, delay=delay)
+
+  async def get(self, timeout=None):
+    """Get the next WorkItem, or None if there is none.
+
+    With a `timeout` in seconds, waits for up to that long for an item to be put.
+    """
+
+    try:
+      return await self._consumer.next(timeout=timeout)
+    except StopAsyncIteration:
+      return None
+
+  async def get_many(self, n):
+    return await self._consumer.next_batch(n)
+
+  async def stats(self):
+    """Statistics of the queue and every consumer registered on it. See `_AppendSeq.stats`."""
+
+    now = time()
+    seq = self._producer._list
+    return workqueue._parse_stats(
+      await seq._scripts.stats(keys=[seq._key], args=seq._stats_args(now)), now)
+
+  async def collect(self):
+    """Collect consumed segments of the queue, subject to its `retention` settings, returning how
+    many items were deleted.
+    """
+
+    deleted = 0
+    while True:
+      n = await self._producer._list.collect(**self._retention)
+      if not n:
+        return deleted
+      deleted += n
+
+  async def close(self):
+    await self._consumer.close()
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._producer._list._key)
@@ -0,0 +1,62 @@
+"""
+Placement of queues over several independent Redis nodes.
+
+A `RedisCluster` is a set of Redis connections between which keys are placed by consistent hashing,
+so that adding or removing a node only moves the keys that node gains or loses. Queues are placed
+whole - every key of a queue lives on the node of the queue's key - so that every queue operation
+stays a single round trip to a single node.
+
+This is not Redis Cluster. The nodes are ordinary Redis servers which know nothing of each other.
+"""
+
+from __future__ import absolute_import
+
+from bisect import bisect
+from hashlib import md5
+
+
+def _hash(key):
+  if not isinstance(key, bytes):
+    key = key.encode("utf-8")
+  return int(md5(key).hexdigest()[:16], 16)
+
+
+def _node_name(conn):
+  kwargs = conn.connection_pool.connection_kwargs
+  return "%s:%s/%s" % (kwargs.get("host", kwargs.get("path")), kwargs.get("port"),
+                       kwargs.get("db", 0))
+
+
+class RedisCluster(object):
+  """A consistent hash ring of Redis connections.
+
+  Each node is placed at `replicas` points around the ring by the hash of its name (its host, port
+  and db), and a key belongs to the node at the first point after the key's hash. Node order is
+  irrelevant, but renaming a node moves its keys.
+  """
+
+  def __init__(self, nodes, replicas=128):
+    assert nodes
+
+    self.nodes = list(nodes)
+    self._ring = sorted((_hash("%s#%d" % (_node_name(node), replica)), idx)
+                        for idx, node in enumerate(self.nodes)
+                        for replica in range(replicas))
+    self._points = [point for point, _ in self._ring]
+
+  def node_for(self, key):
+    """The connection to the node the given key is placed on."""
+
+    pos = bisect(self._points, _hash(key)) % len(self._ring)
+    return self.nodes[self._ring[pos][1]]
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, [_node_name(node) for node in self.nodes])
+
+
+def resolve(conn, key):
+  """The connection for the given key, from either a single connection or a cluster."""
+
+  if isinstance(conn, RedisCluster):
+    return conn.node_for(key)
+  return conn
@@ -0,0 +1,86 @@
+"""
+Codecs for the payloads of work queues.
+
+A codec is a pair of an encoder from values to the bytes stored in Redis, and a decoder from those
+bytes back to values. Decoders accept the bytes Redis returns directly.
+
+The codec of a queue cannot change once it has been written to.
+"""
+
+from __future__ import absolute_import
+
+import json
+import struct
+import zlib
+
+
+def _json_encode(value):
+  return json.dumps(value, separators=(",", ":"))
+
+
+def _json_decode(blob):
+  return json.loads(blob)
+
+
+def _msgpack_codec():
+  # msgpack is only needed by queues which use it
+  import msgpack
+
+  def _encode(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+  def _decode(blob):
+    return msgpack.unpackb(blob, raw=False)
+
+  return _encode, _decode
+
+
+_UINT64 = struct.Struct(">Q")
+
+
+def _uint64_encode(value):
+  return _UINT64.pack(int(value))
+
+
+def _uint64_decode(blob):
+  return _UINT64.unpack(blob)[0]
+
+
+CODECS = {
+  # Compact JSON text, for arbitrary JSON data
+  "json": lambda: (_json_encode, _json_decode),
+  # MessagePack, for arbitrary JSON data in a compact binary form
+  "msgpack": _msgpack_codec,
+  # Unsigned integers packed into 8 bytes, for ID queues. Decodes to int.
+  "uint64": lambda: (_uint64_encode, _uint64_decode),
+}
+
+
+def make_codec(codec="json", compress=False):
+  """Get the (encoder, decoder) pair for the named codec.
+
+  If `compress` is truthy, encoded payloads are additionally zlib compressed, at the given level if
+  `compress` is an int.
+  """
+
+  if codec not in CODECS:
+    raise ValueError("Unknown queue codec %r, expected one of %s"
+                     % (codec, ", ".join(sorted(CODECS))))
+
+  encode, decode = CODECS[codec]()
+
+  if compress:
+    level = compress if compress is not True else zlib.Z_DEFAULT_COMPRESSION
+
+    def _compressed_encode(value):
+      blob = encode(value)
+      if not isinstance(blob, bytes):
+        blob = blob.encode("utf-8")
+      return zlib.compress(blob, level)
+
+    def _compressed_decode(blob):
+      return decode(zlib.decompress(blob))
+
+    return _compressed_encode, _compressed_decode
+
+  return encode, decode
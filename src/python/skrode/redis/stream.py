@@ -0,0 +1,481 @@
+"""
+A durable queue backed by a Redis stream.
+
+Provides the same `WorkItem` and `WorkQueue` API as :py:mod:`skrode.redis.workqueue`, on a stream
+with a consumer group (Redis 6.2 or later). The stream's pending entries list stands in for leases:
+an entry delivered to a consumer is pending until acknowledged, and an entry which has been pending
+for longer than the visibility timeout is claimed back and redelivered. Every operation is a single
+scripted round trip, as with the key-per-item queue, so that either backend can be chosen per queue.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import os
+from random import random
+import socket
+from time import time
+from weakref import WeakKeyDictionary
+
+from skrode.redis.cluster import resolve
+from skrode.redis.workqueue import _CANCEL_POLL, _Scripts as _QueueScripts
+
+
+log = logging.getLogger(__name__)
+
+# Entries have a single field, "v", holding their value.
+#
+# KEYS[1]: the stream
+# ARGV[1]: the channel to notify, ARGV[2]: the approximate max length or "", ARGV[3...]: the values
+#
+# Appends the values to the stream, returning the ID of the first.
+_ADD_LUA = """
+local first = false
+for i = 3, #ARGV do
+  local id
+  if ARGV[2] ~= "" then
+    id = redis.call("xadd", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "v", ARGV[i])
+  else
+    id = redis.call("xadd", KEYS[1], "*", "v", ARGV[i])
+  end
+  first = first or id
+end
+if first then
+  redis.call("publish", ARGV[1], first)
+end
+return first
+"""
+
+# KEYS[1]: the stream, KEYS[2]: the stream's dead letters
+# ARGV[1]: the consumer group, ARGV[2]: the consumer, ARGV[3]: the visibility timeout in ms,
+# ARGV[4]: the most entries to claim, ARGV[5]: the most delivery attempts of an entry or 0
+#
+# Claims up to ARGV[4] entries, returning a list of {id, value}. Entries which have been pending for
+# longer than the visibility timeout are claimed back before new entries are read. An entry which
+# was trimmed while pending is acknowledged and dropped, and an entry which has already been
+# delivered the most attempts is moved to the dead letters.
+#
+# Only the oldest ARGV[4] pending entries are considered for redelivery, which is usually right as
+# the oldest entries are usually the longest pending.
+_CLAIM_LUA = """
+local stream, group, consumer = KEYS[1], ARGV[1], ARGV[2]
+local n, max_attempts = tonumber(ARGV[4]), tonumber(ARGV[5])
+
+local result = {}
+local claimed = redis.call("xautoclaim", stream, group, consumer, ARGV[3], "0-0", "COUNT", n)[2]
+for _, entry in ipairs(claimed) do
+  local id, fields = entry[1], entry[2]
+  if not fields then
+    redis.call("xack", stream, group, id)
+  elseif max_attempts > 0 and
+         redis.call("xpending", stream, group, id, id, 1)[1][4] > max_attempts then
+    redis.call("xadd", KEYS[2], "*", "v", fields[2])
+    redis.call("xack", stream, group, id)
+  else
+    result[#result + 1] = {id, fields[2]}
+  end
+end
+
+if #result < n then
+  local read = redis.call("xreadgroup", "GROUP", group, consumer, "COUNT", n - #result,
+                          "STREAMS", stream, ">")
+  if read then
+    for _, entry in ipairs(read[1][2]) do
+      result[#result + 1] = {entry[1], entry[2][2]}
+    end
+  end
+end
+return result
+"""
+
+# KEYS[1]: the stream, KEYS[2]: the stream's dead letters
+# ARGV[1]: the channel to notify, ARGV[2]: the approximate max length or "", ARGV[3]: the dead
+# letters' consumer group, ARGV[4]: its consumer, ARGV[5]: its visibility timeout in ms,
+# ARGV[6]: the most entries to requeue
+#
+# Claims up to ARGV[6] dead letters as _CLAIM_LUA, appends them to the stream and acknowledges them,
+# all at once so that a crash can neither lose nor duplicate a letter. Returns how many were
+# requeued.
+_REQUEUE_LUA = """
+local dead, group, consumer, n = KEYS[2], ARGV[3], ARGV[4], tonumber(ARGV[6])
+
+local entries = redis.call("xautoclaim", dead, group, consumer, ARGV[5], "0-0", "COUNT", n)[2]
+if #entries < n then
+  local read = redis.call("xreadgroup", "GROUP", group, consumer, "COUNT", n - #entries,
+                          "STREAMS", dead, ">")
+  if read then
+    for _, entry in ipairs(read[1][2]) do
+      entries[#entries + 1] = entry
+    end
+  end
+end
+
+local first, moved = false, 0
+for _, entry in ipairs(entries) do
+  local id, fields = entry[1], entry[2]
+  if fields then
+    local added
+    if ARGV[2] ~= "" then
+      added = redis.call("xadd", KEYS[1], "MAXLEN", "~", ARGV[2], "*", "v", fields[2])
+    else
+      added = redis.call("xadd", KEYS[1], "*", "v", fields[2])
+    end
+    first = first or added
+    moved = moved + 1
+  end
+  redis.call("xack", dead, group, id)
+end
+if first then
+  redis.call("publish", ARGV[1], first)
+end
+return moved
+"""
+
+# KEYS[1]: the stream
+# ARGV[1]: the consumer group, ARGV[2]: the consumer, ARGV[3]: the entry's ID,
+# ARGV[4]: the visibility timeout in ms, ARGV[5]: the base retry delay in ms,
+# ARGV[6]: the most retry delay in ms, ARGV[7]: a random number in [0, 1)
+#
+# Makes an aborted entry claimable again after a retry delay, by setting how long it has been
+# pending to the visibility timeout less the delay. The delay backs off exponentially with the
+# number of times the entry has been delivered, and is jittered down by up to half.
+_ABORT_LUA = """
+local pending = redis.call("xpending", KEYS[1], ARGV[1], ARGV[3], ARGV[3], 1)[1]
+if not pending then
+  return false
+end
+local delay = math.min(tonumber(ARGV[5]) * 2 ^ (pending[4] - 1), tonumber(ARGV[6]))
+delay = delay * (1 - tonumber(ARGV[7]) / 2)
+local idle = math.max(math.floor(tonumber(ARGV[4]) - delay), 0)
+redis.call("xclaim", KEYS[1], ARGV[1], ARGV[2], 0, ARGV[3], "IDLE", idle, "JUSTID")
+return true
+"""
+
+# Reads the info of a consumer group as a table.
+_GROUP_INFO_LUA = """
+local function group_info(stream, group)
+  for _, info in ipairs(redis.call("xinfo", "groups", stream)) do
+    local fields = {}
+    for i = 1, #info, 2 do
+      fields[info[i]] = info[i + 1]
+    end
+    if fields["name"] == group then
+      return fields
+    end
+  end
+end
+"""
+
+# KEYS[1]: the stream
+# ARGV[1]: the consumer group
+#
+# Returns the number of entries the group has yet to read. Where Redis doesn't track the group's
+# lag (before Redis 7), pages through the entries either side of the group's last delivered ID in
+# turn until one side is exhausted, taking the unread entries as the stream's length less the read
+# ones if those run out first. This is linear in the lesser of the backlog and the read entries
+# still held, which collection keeps to those pending or read since it last ran.
+_BACKLOG_LUA = _GROUP_INFO_LUA + """
+local info = group_info(KEYS[1], ARGV[1])
+if info["lag"] then
+  return info["lag"]
+end
+
+local last = info["last-delivered-id"]
+local unread, read = {start = "(" .. last, stop = "+", n = 0}, {start = "-", stop = last, n = 0}
+local function exhausted(range)
+  local entries = redis.call("xrange", KEYS[1], range.start, range.stop, "COUNT", 1024)
+  range.n = range.n + #entries
+  if #entries < 1024 then
+    return true
+  end
+  range.start = "(" .. entries[#entries][1]
+  return false
+end
+
+while true do
+  if exhausted(unread) then
+    return unread.n
+  end
+  if exhausted(read) then
+    return redis.call("xlen", KEYS[1]) - read.n
+  end
+end
+"""
+
+# KEYS[1]: the stream
+# ARGV[1]: the consumer group, ARGV[2]: the max age cutoff in ms or "", ARGV[3]: the max length
+# or ""
+#
+# Trims entries which the group has read and acknowledged, and any entries older than the max age
+# or beyond the max length whether read or not. Returns the number of entries deleted.
+_COLLECT_LUA = _GROUP_INFO_LUA + """
+local stream = KEYS[1]
+local low = group_info(stream, ARGV[1])["last-delivered-id"]
+local pending = redis.call("xpending", stream, ARGV[1])
+if pending[1] > 0 then
+  low = pending[2]
+end
+
+local deleted = redis.call("xtrim", stream, "MINID", low)
+if ARGV[2] ~= "" then
+  deleted = deleted + redis.call("xtrim", stream, "MINID", ARGV[2])
+end
+if ARGV[3] ~= "" then
+  deleted = deleted + redis.call("xtrim", stream, "MAXLEN", ARGV[3])
+end
+return deleted
+"""
+
+
+class _Scripts(_QueueScripts):
+  """Helper class.
+
+  The Lua scripts implementing stream queue operations, registered against a single connection.
+  """
+
+  _registry = WeakKeyDictionary()
+
+  def __init__(self, conn):
+    self.add = conn.register_script(_ADD_LUA)
+    self.claim = conn.register_script(_CLAIM_LUA)
+    self.requeue = conn.register_script(_REQUEUE_LUA)
+    self.abort = conn.register_script(_ABORT_LUA)
+    self.backlog = conn.register_script(_BACKLOG_LUA)
+    self.collect = conn.register_script(_COLLECT_LUA)
+
+
+class WorkItem(object):
+  """
+  Helper class to WorkQueue.
+
+  Represents a stream entry to be processed as returned by `WorkQueue.get`, with the same interface
+  as :py:class:`skrode.redis.workqueue.WorkItem`.
+  """
+
+  def __init__(self, queue, id, raw):
+    self._queue = queue
+    self._idx = id
+    self._raw = raw
+
+  @property
+  def value(self):
+    return self._queue._decoder(self._raw)
+
+  def complete(self):
+    """Acknowledge that this work item has been processed, removing it from the pending entries."""
+
+    self._queue._conn.execute_command("XACK", self._queue._key, self._queue._group, self._idx)
+
+  def abort(self, retry_in=None):
+    """Admit a failure to process this work item and put it back on the queue.
+
+    The item is redelivered by the next claim, or with a `retry_in` delay in seconds (defaulting to
+    the queue's) once the delay has passed, backing off as with
+    :py:meth:`skrode.redis.workqueue.WorkItem.abort`.
+    """
+
+    if retry_in is None:
+      retry_in = self._queue._retry_in
+    self._queue._scripts.abort(
+      keys=[self._queue._key],
+      args=[self._queue._group, self._queue._consumer_name(), self._idx,
+            int(self._queue._visibility_timeout * 1000), int(retry_in * 1000),
+            int(self._queue._max_retry_delay * 1000), random()])
+
+  def extend(self):
+    """Renew this work item's lease for another visibility timeout from now."""
+
+    self._queue._conn.execute_command("XCLAIM", self._queue._key, self._queue._group,
+                                      self._queue._consumer_name(), 0, self._idx, "IDLE", 0,
+                                      "JUSTID")
+
+  def release(self):
+    """Give up this work item unprocessed, to be redelivered at once.
+
+    Streams count deliveries themselves, so the claim still counts as an attempt.
+    """
+
+    self.abort(retry_in=0)
+
+  def __enter__(self):
+    return self.value
+
+  def __exit__(self, type, value, traceback):
+    if type is None and value is None and traceback is None:
+      self.complete()
+    else:
+      self.abort()
+
+
+class WorkQueue(object):
+  """The `WorkQueue` API over a Redis stream, consumed by a single consumer group shared by all
+  connected clients.
+
+  Each process reads as its own consumer within the group, and entries pending for longer than
+  `visibility_timeout` seconds are claimed back by whichever process claims next, so an entry held
+  by a process which died is redelivered. Options are as
+  :py:class:`skrode.redis.workqueue.WorkQueue` where they apply.
+
+  Entries are trimmed by `collect` once the group has acknowledged them, or by `retention`. A
+  retention `max_length` also caps the stream approximately as entries are added.
+  """
+
+  def __init__(self, conn, key, group="implicit_consumer", decoder=None, encoder=None,
+               retention=None, visibility_timeout=300, retry_in=0, max_retry_delay=3600,
+               max_attempts=None):
+    conn = resolve(conn, key)
+    self._conn = conn
+    self._key = key
+    self._group = group
+    self._decoder = decoder or (lambda x: x)
+    self._encoder = encoder or (lambda x: x)
+    self._retention = retention if retention is not None else {}
+    self._visibility_timeout = visibility_timeout
+    self._retry_in = retry_in
+    self._max_retry_delay = max_retry_delay
+    self._max_attempts = max_attempts or 0
+    self._scripts = _Scripts.of(conn)
+    self._pubsub = None
+    self.channel = "%s/notify" % (key,)
+
+    try:
+      conn.execute_command("XGROUP", "CREATE", key, group, "0", "MKSTREAM")
+    except Exception as e:
+      if "BUSYGROUP" not in str(e):
+        raise
+
+  def _consumer_name(self):
+    # Processes are forked with queues already constructed, so name consumers when claiming.
+    return "%s/%d" % (socket.gethostname(), os.getpid())
+
+  def __len__(self):
+    """The number of entries the group has yet to read."""
+
+    return self._scripts.backlog(keys=[self._key], args=[self._group])
+
+  def put(self, val):
+    return self.put_many([val])
+
+  def put_many(self, vals):
+    """Enqueue all of the given values in order, returning the ID of the first."""
+
+    return self._scripts.add(keys=[self._key],
+                             args=[self.channel, self._retention.get("max_length", "")] +
+                             [self._encoder(val) for val in vals])
+
+  def get_many(self, n):
+    """Claim up to `n` WorkItems at once, returning a possibly empty list of them."""
+
+    claimed = self._scripts.claim(keys=[self._key, "%s/dead" % (self._key,)],
+                                  args=[self._group, self._consumer_name(),
+                                        int(self._visibility_timeout * 1000), n,
+                                        self._max_attempts])
+    return [WorkItem(self, id, raw) for id, raw in claimed]
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting to be notified of a put, or
+    until the `cancel` event is set. While waiting, the claim is only tried again once notified of
+    a put or once the oldest pending entry times out, so an idle consumer makes no calls.
+    """
+
+    deadline = time() + (timeout or 0)
+    while True:
+      items = self.get_many(1)
+      if items:
+        return items[0]
+
+      if deadline - time() <= 0 or (cancel is not None and cancel.is_set()):
+        return None
+
+      if self._pubsub is None:
+        # Subscribe and then check again, so that a put racing the subscription isn't missed.
+        self._pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+        continue
+
+      self._wait(min(deadline, self._next_timeout()), cancel)
+
+  def _next_timeout(self):
+    # Claims only consider the oldest pending entry for redelivery, so it's the one to wait on.
+    pending = self._conn.xpending_range(self._key, self._group, "-", "+", 1)
+    if not pending:
+      return float("inf")
+    idle = pending[0]["time_since_delivered"] / 1000.0
+    return time() + max(self._visibility_timeout - idle, 0)
+
+  def _wait(self, until, cancel):
+    """Wait to be notified of a put until the given time, or until the `cancel` event is set."""
+
+    while True:
+      remaining = until - time()
+      if remaining <= 0 or (cancel is not None and cancel.is_set()):
+        return
+      if cancel is not None:
+        remaining = min(remaining, _CANCEL_POLL)
+
+      if self._pubsub.get_message(timeout=remaining) is not None:
+        while self._pubsub.get_message() is not None:
+          pass
+        return
+
+  def stats(self):
+    """The `length` of the stream, its `backlog` of unread entries and the number of entries
+    `inflight` pending acknowledgement.
+    """
+
+    with self._conn.pipeline(transaction=False) as p:
+      p.execute_command("XLEN", self._key)
+      p.execute_command("XPENDING", self._key, self._group)
+      length, pending = p.execute()
+
+    if isinstance(pending, dict):
+      pending = [pending["pending"]]
+    return {"length": length, "backlog": len(self), "inflight": pending[0]}
+
+  def collect(self):
+    """Trim acknowledged entries, subject to the queue's `retention` settings (`max_age` in seconds
+    and `max_length`), returning how many entries were deleted.
+    """
+
+    max_age = self._retention.get("max_age")
+    return self._scripts.collect(
+      keys=[self._key],
+      args=[self._group,
+            "" if max_age is None else "%d-0" % ((time() - max_age) * 1000,),
+            self._retention.get("max_length", "")])
+
+  def dead_letters(self):
+    """The queue of this queue's dead letters, holding their raw undecoded values."""
+
+    return WorkQueue(self._conn, "%s/dead" % (self._key,), group=self._group)
+
+  def requeue_dead(self, n=None):
+    """Move up to `n` (by default all) dead letters back to the end of this queue, returning how
+    many were moved.
+    """
+
+    dead = self.dead_letters()
+    moved = 0
+    while n is None or moved < n:
+      requeued = self._scripts.requeue(
+        keys=[self._key, dead._key],
+        args=[self.channel, self._retention.get("max_length", ""), dead._group,
+              dead._consumer_name(), int(dead._visibility_timeout * 1000),
+              1024 if n is None else min(n - moved, 1024)])
+      if not requeued:
+        break
+      moved += requeued
+    dead.collect()
+    return moved
+
+  def close(self):
+    """Release the notification subscription, if `get` opened one."""
+
+    if self._pubsub is not None:
+      self._pubsub.close()
+      self._pubsub = None
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._key)
@@ -0,0 +1,108 @@
+"""
+Streaming export and import of work queues, for moving a queue between Redis instances or
+snapshotting it.
+
+A dump is a sequence of records of each item's index in the source queue and its raw stored value,
+in index order, either as NDJSON (one `{"idx": ..., "value": <base64>}` object per line) or in a
+compact binary format. Values are stored bytes, so dumps are independent of the queue's codec, but
+must be loaded into a queue with the same codec to be readable.
+
+Loading appends the values in order to the end of the target queue, which assigns them fresh
+indices. Consumer cursors, leases and statistics are not dumped.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import json
+import struct
+
+
+_BINARY_MAGIC = b"SKRODEQD"
+_BINARY_RECORD = struct.Struct(">QI")
+
+FORMATS = ("ndjson", "binary")
+
+
+def _seq_of(queue):
+  """The underlying sequence of a WorkQueue, Producer or Consumer."""
+
+  if hasattr(queue, "_producer"):
+    return queue._producer._list
+  return queue._list
+
+
+def dump(queue, fileobj, start=None, end=None, format="ndjson", batch=1024):
+  """Write the items of the queue with indices in [start, end), by default every uncollected item,
+  to a binary file object. Returns the number of items written.
+  """
+
+  assert format in FORMATS
+
+  if format == "binary":
+    fileobj.write(_BINARY_MAGIC)
+
+  n = 0
+  for idx, val in _seq_of(queue).read_range(start, end, batch=batch):
+    if format == "binary":
+      fileobj.write(_BINARY_RECORD.pack(idx, len(val)))
+      fileobj.write(val)
+    else:
+      record = {"idx": idx, "value": base64.b64encode(val).decode("ascii")}
+      fileobj.write(json.dumps(record, separators=(",", ":")).encode("utf-8") + b"\n")
+    n += 1
+  return n
+
+
+def _read_records(fileobj, format):
+  if format == "binary":
+    if fileobj.read(len(_BINARY_MAGIC)) != _BINARY_MAGIC:
+      raise ValueError("Not a binary queue dump")
+    while True:
+      header = fileobj.read(_BINARY_RECORD.size)
+      if not header:
+        return
+      idx, length = _BINARY_RECORD.unpack(header)
+      yield idx, fileobj.read(length)
+  else:
+    for line in fileobj:
+      if line.strip():
+        record = json.loads(line.decode("utf-8"))
+        yield record["idx"], base64.b64decode(record["value"])
+
+
+def load(queue, fileobj, format="ndjson", batch=1024, pipeline=16):
+  """Append every item of a dump read from a binary file object to the end of the queue, in order.
+  Returns the number of items loaded.
+
+  Items are appended `batch` to a scripted push, bypassing deduplication, and `pipeline` pushes are
+  sent per round trip.
+  """
+
+  assert format in FORMATS
+
+  seq = _seq_of(queue)
+  n = 0
+  batches = []
+
+  def _flush():
+    with seq._conn.pipeline(transaction=False) as p:
+      for vals in batches:
+        seq._push(vals, 0, client=p)
+      p.execute()
+    del batches[:]
+
+  vals = []
+  for _, val in _read_records(fileobj, format):
+    vals.append(val)
+    n += 1
+    if len(vals) == batch:
+      batches.append(vals)
+      vals = []
+      if len(batches) == pipeline:
+        _flush()
+  if vals:
+    batches.append(vals)
+  if batches:
+    _flush()
+  return n
@@ -2,7 +2,559 @@
 A simple durable queue backed by Redis.
 """
 
-from redis import WatchError
+from collections import deque, OrderedDict
+import logging
+import os
+from random import random
+import socket
+import threading
+from time import sleep, time
+from uuid import uuid4
+from weakref import WeakKeyDictionary
+from zlib import crc32
+
+from skrode.redis.cluster import resolve
+
+
+log = logging.getLogger(__name__)
+
+# Enqueue and dequeue events are counted in buckets of this many seconds, from which rates are
+# reported over each of these windows in seconds.
+_RATE_BUCKET = 10
+_RATE_WINDOWS = (60, 300, 900)
+
+# Blocking waits given a `cancel` event check it this often in seconds, without calling Redis.
+_CANCEL_POLL = 1.0
+
+
+# Lua helpers shared by every script. Item keys are formatted exactly as `_AppendSeq.__idx_key__`
+# and `_AppendSeq.__chunk_key__` format them, so scripted and unscripted access agree on the layout.
+#
+# Every script touching items takes the sequence's layout as its leading five arguments: the item
+# key suffix, the chunk size, the segment size, and the width and TTL in seconds of the buckets
+# events are counted in (see `_AppendSeq._layout`). Items are stored either one per key (a chunk
+# size of 0), or packed into hashes of `chunk` items keyed by each item's offset into its chunk.
+#
+# Scripts claiming items take the terms of the claim as their next three arguments: the current
+# time, the lease deadline and the most delivery attempts of an item or 0 (see
+# `Consumer._claim_args`).
+_LUA_PRELUDE = """
+local function layout_of(argv)
+  return {suffix = argv[1], chunk = tonumber(argv[2]), size = tonumber(argv[3]),
+          bucket = tonumber(argv[4]), bucket_ttl = tonumber(argv[5])}
+end
+
+local function terms_of(argv)
+  return {now = argv[6], deadline = argv[7], max_attempts = tonumber(argv[8])}
+end
+
+local function idx_key(seq, layout, idx)
+  return string.format("%s%s%016x", seq, layout.suffix, idx)
+end
+
+local function chunk_key(seq, layout, idx)
+  return string.format("%s%schunk/%016x", seq, layout.suffix, math.floor(idx / layout.chunk))
+end
+
+local function get_int(key)
+  return tonumber(redis.call("get", key) or "0")
+end
+
+local function get_attempts(leases, idx)
+  return tonumber(redis.call("hget", leases .. "/attempts", idx) or "0")
+end
+
+local function store(seq, layout, idx, val)
+  if layout.chunk == 0 then
+    redis.call("set", idx_key(seq, layout, idx), val)
+  else
+    redis.call("hset", chunk_key(seq, layout, idx), idx % layout.chunk, val)
+  end
+end
+
+-- Read the values at the given indices. Per-item keys are read in batches to stay clear of Lua's
+-- limit on unpacked arguments.
+local function fetch(seq, layout, idxs)
+  local vals = {}
+  if layout.chunk == 0 then
+    for batch = 1, #idxs, 1024 do
+      local keys = {}
+      for i = batch, math.min(batch + 1023, #idxs) do
+        keys[#keys + 1] = idx_key(seq, layout, idxs[i])
+      end
+      for _, val in ipairs(redis.call("mget", unpack(keys))) do
+        vals[#vals + 1] = val
+      end
+    end
+  else
+    for i, idx in ipairs(idxs) do
+      vals[i] = redis.call("hget", chunk_key(seq, layout, idx), idx % layout.chunk)
+    end
+  end
+  return vals
+end
+
+-- Delete the items at the indices [from, to), which must span whole chunks.
+local function drop(seq, layout, from, to)
+  if layout.chunk == 0 then
+    for batch = from, to - 1, 1024 do
+      local keys = {}
+      for idx = batch, math.min(batch + 1024, to) - 1 do
+        keys[#keys + 1] = idx_key(seq, layout, idx)
+      end
+      redis.call("del", unpack(keys))
+    end
+  else
+    for idx = from, to - 1, layout.chunk do
+      redis.call("del", chunk_key(seq, layout, idx))
+    end
+  end
+end
+
+-- Count n events against a counter, and against the counter's bucket of the current time. Buckets
+-- expire once they fall out of the widest rate window.
+local function count(counter, layout, n, now)
+  redis.call("incrby", counter, n)
+  local bucket = counter .. "/" .. math.floor(tonumber(now) / layout.bucket)
+  redis.call("incrby", bucket, n)
+  redis.call("expire", bucket, layout.bucket_ttl)
+end
+
+-- Append values to the end of a sequence, returning the index of the first. Records when each
+-- segment was first written to for retention.
+local function append(seq, layout, now, vals)
+  local start = get_int(seq)
+  local n = #vals
+  if n > 0 then
+    for i = 1, n do
+      store(seq, layout, start + i - 1, vals[i])
+    end
+    redis.call("incrby", seq, n)
+    for segment = math.floor(start / layout.size), math.floor((start + n - 1) / layout.size) do
+      redis.call("hsetnx", seq .. "/segments", segment, now)
+    end
+    count(seq .. "/stats/enqueued", layout, n, now)
+  end
+  return start
+end
+
+-- Append the delayed values of a sequence which have come due. Delayed values are kept in a sorted
+-- set scored by when they are due, each prefixed with a unique 16 hex digit ID and a colon.
+local function promote(seq, layout, now)
+  local due = redis.call("zrangebyscore", seq .. "/delayed", "-inf", now, "LIMIT", 0, 1024)
+  if #due > 0 then
+    local vals = {}
+    for i, member in ipairs(due) do
+      vals[i] = string.sub(member, 18)
+    end
+    append(seq, layout, now, vals)
+    redis.call("zrem", seq .. "/delayed", unpack(due))
+  end
+end
+
+-- Claim up to n items for a consumer, returning their indices. Due delayed values are appended
+-- first. Items whose leases have expired (or which were aborted) are redelivered before the cursor
+-- is advanced over unclaimed indices. Every claimed item is leased until the deadline, and has its
+-- delivery attempts counted. Indices below the sequence's base have been collected, and are
+-- skipped.
+--
+-- An expired item which has already been delivered the most attempts is instead appended to the
+-- sequence's dead letters at `<seq>/dead`, and forgotten by the consumer.
+local function claim(seq, layout, cursor, leases, n, terms)
+  local now, deadline = terms.now, terms.deadline
+  promote(seq, layout, now)
+
+  local base = get_int(seq .. "/base")
+  local idxs, dead = {}, {}
+  for _, idx in ipairs(redis.call("zrangebyscore", leases, "-inf", now, "LIMIT", 0, n)) do
+    if tonumber(idx) < base then
+      redis.call("zrem", leases, idx)
+      redis.call("hdel", leases .. "/attempts", idx)
+    elseif terms.max_attempts > 0 and get_attempts(leases, idx) >= terms.max_attempts then
+      dead[#dead + 1] = tonumber(idx)
+    else
+      idxs[#idxs + 1] = tonumber(idx)
+    end
+  end
+
+  if #dead > 0 then
+    append(seq .. "/dead", layout, now, fetch(seq, layout, dead))
+    redis.call("zrem", leases, unpack(dead))
+    redis.call("hdel", leases .. "/attempts", unpack(dead))
+  end
+
+  local stored = get_int(cursor)
+  local cur = math.max(stored, base)
+  local fresh = math.min(n - #idxs, get_int(seq) - cur)
+  if fresh > 0 then
+    redis.call("incrby", cursor, cur + fresh - stored)
+    for i = 0, fresh - 1 do
+      idxs[#idxs + 1] = cur + i
+    end
+  end
+
+  for _, idx in ipairs(idxs) do
+    redis.call("zadd", leases, deadline, idx)
+    redis.call("hincrby", leases .. "/attempts", idx, 1)
+  end
+  if #idxs > 0 then
+    count(cursor .. "/stats/dequeued", layout, #idxs, now)
+  end
+  return idxs
+end
+"""
+
+# KEYS[1]: the sequence's length key
+# ARGV[1...5]: the layout, ARGV[6]: the channel to notify, ARGV[7]: the current time,
+# ARGV[8]: the dedupe window in seconds or 0, ARGV[9...]: the values to append
+#
+# Returns the pair {index of the first appended value, number of values appended}. Publishes that
+# index to the notification channel so that blocked consumers wake up.
+#
+# With a dedupe window, values already appended within the window are dropped. Digests of appended
+# values are kept in a set per window-sized bucket of time, and a value is a duplicate if it is in
+# the current or previous bucket, so values are suppressed for between one and two windows.
+_APPEND_LUA = """
+local seq, window = KEYS[1], tonumber(ARGV[8])
+
+local vals = {}
+if window > 0 then
+  local bucket = math.floor(tonumber(ARGV[7]) / window)
+  local current = seq .. "/dedupe/" .. bucket
+  local previous = seq .. "/dedupe/" .. (bucket - 1)
+  for i = 9, #ARGV do
+    local digest = redis.sha1hex(ARGV[i])
+    if redis.call("sismember", previous, digest) == 0 and
+       redis.call("sadd", current, digest) == 1 then
+      vals[#vals + 1] = ARGV[i]
+    end
+  end
+  redis.call("expire", current, 2 * window)
+  if #vals < #ARGV - 8 then
+    redis.call("incrby", seq .. "/stats/duplicates", #ARGV - 8 - #vals)
+  end
+else
+  for i = 9, #ARGV do
+    vals[#vals + 1] = ARGV[i]
+  end
+end
+
+local start = append(seq, layout_of(ARGV), ARGV[7], vals)
+if #vals > 0 then
+  redis.call("publish", ARGV[6], start)
+end
+return {start, #vals}
+"""
+
+# KEYS[1]: the sequence's length key
+# ARGV[1]: when the values are due, ARGV[2...]: the values to delay
+#
+# Schedules values to be appended once they are due, returning how many were scheduled.
+_DELAY_LUA = """
+local delayed = KEYS[1] .. "/delayed"
+for i = 2, #ARGV do
+  local id = redis.call("incr", delayed .. "/ids")
+  redis.call("zadd", delayed, ARGV[1], string.format("%016x:", id) .. ARGV[i])
+end
+return #ARGV - 1
+"""
+
+# KEYS[1]: the sequence's length key, KEYS[2]: the consumer's cursor key, KEYS[3]: the consumer's
+# lease set
+# ARGV[1...5]: the layout, ARGV[6...8]: the terms of the claim
+#
+# Returns the claimed index, or nil if there is nothing to claim.
+_CLAIM_LUA = """
+local idxs = claim(KEYS[1], layout_of(ARGV), KEYS[2], KEYS[3], 1, terms_of(ARGV))
+if #idxs == 0 then
+  return false
+end
+return idxs[1]
+"""
+
+# KEYS, ARGV: as _CLAIM_LUA
+#
+# As _CLAIM_LUA, but returns the pair {index, value}.
+_CLAIM_FETCH_LUA = """
+local layout = layout_of(ARGV)
+local idxs = claim(KEYS[1], layout, KEYS[2], KEYS[3], 1, terms_of(ARGV))
+if #idxs == 0 then
+  return false
+end
+return {idxs[1], fetch(KEYS[1], layout, idxs)[1]}
+"""
+
+# KEYS: as _CLAIM_LUA
+# ARGV[1...8]: as _CLAIM_LUA, ARGV[9]: the most items to claim
+#
+# Returns the pair {indices, values} for up to ARGV[9] claimed items, or nil if there is nothing to
+# claim.
+_CLAIM_BATCH_LUA = """
+local layout = layout_of(ARGV)
+local idxs = claim(KEYS[1], layout, KEYS[2], KEYS[3], tonumber(ARGV[9]), terms_of(ARGV))
+if #idxs == 0 then
+  return false
+end
+return {idxs, fetch(KEYS[1], layout, idxs)}
+"""
+
+# KEYS: a (length key, cursor key, lease set) triple for each lane of a priority queue, in the order
+# the lanes are to be drained
+# ARGV: as _CLAIM_BATCH_LUA
+#
+# Claims up to ARGV[9] items, draining each lane before moving on to the next. Returns a list of
+# {lane number from 0, indices, values} for each lane claimed from.
+_CLAIM_LANES_LUA = """
+local layout, terms = layout_of(ARGV), terms_of(ARGV)
+local n = tonumber(ARGV[9])
+local result = {}
+for lane = 1, #KEYS / 3 do
+  if n <= 0 then
+    break
+  end
+  local seq = KEYS[lane * 3 - 2]
+  local idxs = claim(seq, layout, KEYS[lane * 3 - 1], KEYS[lane * 3], n, terms)
+  if #idxs > 0 then
+    result[#result + 1] = {lane - 1, idxs, fetch(seq, layout, idxs)}
+    n = n - #idxs
+  end
+end
+return result
+"""
+
+# KEYS[1]: the sequence's length key, KEYS[2...4]: the length key, cursor key and lease set of the
+# sequence's dead letters' consumer
+# ARGV[1...8]: as _CLAIM_LUA, for the dead letters, ARGV[9]: the most items to requeue,
+# ARGV[10]: the sequence's channel to notify
+#
+# Claims up to ARGV[9] dead letters, appends them to the sequence and completes them, all at once so
+# that a crash can neither lose nor duplicate a letter. Returns how many were requeued.
+_REQUEUE_LUA = """
+local layout, terms = layout_of(ARGV), terms_of(ARGV)
+local seq, dead, leases = KEYS[1], KEYS[2], KEYS[4]
+local idxs = claim(dead, layout, KEYS[3], leases, tonumber(ARGV[9]), terms)
+if #idxs == 0 then
+  return 0
+end
+
+local start = append(seq, layout, terms.now, fetch(dead, layout, idxs))
+redis.call("zrem", leases, unpack(idxs))
+redis.call("hdel", leases .. "/attempts", unpack(idxs))
+redis.call("publish", ARGV[10], start)
+return #idxs
+"""
+
+# KEYS[1]: the consumer's lease set
+# ARGV[1]: the index of the aborted item, ARGV[2]: the current time, ARGV[3]: the base retry delay
+# in seconds, ARGV[4]: the most retry delay in seconds, ARGV[5]: a random number in [0, 1)
+#
+# Expires the lease of an aborted item at a retry time backing off exponentially with the number of
+# times it has been delivered, from the base delay up to the most delay. The delay is jittered down
+# by up to half. Returns the retry delay, or nil if the item isn't leased.
+_ABORT_LUA = """
+if not redis.call("zscore", KEYS[1], ARGV[1]) then
+  return false
+end
+local attempts = tonumber(redis.call("hget", KEYS[1] .. "/attempts", ARGV[1]) or "1")
+local delay = math.min(tonumber(ARGV[3]) * 2 ^ (attempts - 1), tonumber(ARGV[4]))
+delay = delay * (1 - tonumber(ARGV[5]) / 2)
+redis.call("zadd", KEYS[1], "XX", tonumber(ARGV[2]) + delay, ARGV[1])
+return tostring(delay)
+"""
+
+# KEYS[1]: the consumer's lease set
+# ARGV[1]: the index of the released item, ARGV[2]: the current time
+#
+# Expires the lease of an item which was claimed but never processed, without counting the claim
+# as a delivery attempt. Returns whether the item was leased.
+_RELEASE_LUA = """
+if not redis.call("zscore", KEYS[1], ARGV[1]) then
+  return false
+end
+redis.call("zadd", KEYS[1], "XX", ARGV[2], ARGV[1])
+redis.call("hincrby", KEYS[1] .. "/attempts", ARGV[1], -1)
+return true
+"""
+
+# KEYS[1]: the sequence's length key
+# ARGV[1...5]: the layout, ARGV[6]: the current time, ARGV[7]: the max age in seconds or "",
+# ARGV[8]: the max length or "", ARGV[9]: the most segments to delete
+#
+# Deletes whole segments below the low watermark - the least index any registered consumer has yet
+# to claim or holds a lease on - or which are past the max age or beyond the max length, whether
+# consumed or not. Returns the number of items deleted.
+_COLLECT_LUA = """
+local seq, layout = KEYS[1], layout_of(ARGV)
+local size = layout.size
+local len, base = get_int(seq), get_int(seq .. "/base")
+
+local low = len
+local consumers = redis.call("hgetall", seq .. "/consumers")
+for i = 1, #consumers, 2 do
+  low = math.min(low, get_int(consumers[i]))
+  for _, idx in ipairs(redis.call("zrange", consumers[i + 1], 0, -1)) do
+    low = math.min(low, tonumber(idx))
+  end
+end
+
+if ARGV[8] ~= "" then
+  low = math.max(low, len - tonumber(ARGV[8]))
+end
+
+if ARGV[7] ~= "" then
+  -- A segment has aged out once the segment after it was first written before the cutoff.
+  local cutoff = tonumber(ARGV[6]) - tonumber(ARGV[7])
+  local segment = math.floor(base / size)
+  while true do
+    local written = redis.call("hget", seq .. "/segments", segment + 1)
+    if not written or tonumber(written) > cutoff then
+      break
+    end
+    segment = segment + 1
+  end
+  low = math.max(low, segment * size)
+end
+
+local first = math.floor(base / size)
+local upto = math.min(math.floor(low / size), first + tonumber(ARGV[9]))
+if upto <= first then
+  return 0
+end
+
+drop(seq, layout, base, upto * size)
+for segment = first, upto - 1 do
+  redis.call("hdel", seq .. "/segments", segment)
+end
+redis.call("set", seq .. "/base", upto * size)
+return upto * size - base
+"""
+
+# KEYS[1]: the sequence's length key
+# ARGV[1]: the segment size, ARGV[2...]: the rate buckets to read, newest first
+#
+# Returns {length, base, enqueued, enqueue buckets, duplicates, consumer...} where each consumer is
+# {id, cursor, leased, when the cursor's segment was first written, dequeued, dequeue buckets}.
+_STATS_LUA = """
+local seq, size = KEYS[1], tonumber(ARGV[1])
+
+local function buckets(counter)
+  local keys = {}
+  for i = 2, #ARGV do
+    keys[#keys + 1] = counter .. "/" .. ARGV[i]
+  end
+  return redis.call("mget", unpack(keys))
+end
+
+local len, base = get_int(seq), get_int(seq .. "/base")
+local result = {len, base, get_int(seq .. "/stats/enqueued"), buckets(seq .. "/stats/enqueued"),
+                get_int(seq .. "/stats/duplicates"), redis.call("zcard", seq .. "/delayed"),
+                get_int(seq .. "/dead/stats/enqueued")}
+
+local consumers = redis.call("hgetall", seq .. "/consumers")
+for i = 1, #consumers, 2 do
+  local cursor = math.max(get_int(consumers[i]), base)
+  local written = false
+  if cursor < len then
+    written = redis.call("hget", seq .. "/segments", math.floor(cursor / size))
+  end
+  result[#result + 1] = {consumers[i], cursor, redis.call("zcard", consumers[i + 1]), written,
+                         get_int(consumers[i] .. "/stats/dequeued"),
+                         buckets(consumers[i] .. "/stats/dequeued")}
+end
+return result
+"""
+
+
+# KEYS[1]: the partitioned queue's key
+# ARGV[1]: the member's ID, ARGV[2]: the current time, ARGV[3]: the ownership TTL in seconds,
+# ARGV[4]: the number of partitions
+#
+# Heartbeats a member of a partitioned queue's consumers, and rebalances its share of the
+# partitions, returning the partition numbers it owns. Members which haven't heartbeat within the
+# TTL are dropped, and every live member's share is the number of partitions divided by the number
+# of live members, rounded up. Each partition is owned via an owner key expiring after the TTL, so
+# a dead member's partitions are freed for the others to take.
+_OWN_LUA = """
+local key, member, now, ttl = KEYS[1], ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local partitions, ttl_ms = tonumber(ARGV[4]), math.ceil(ttl * 1000)
+local members = key .. "/members"
+
+redis.call("zadd", members, now, member)
+redis.call("zremrangebyscore", members, "-inf", now - ttl)
+local share = math.ceil(partitions / redis.call("zcard", members))
+
+local owned = {}
+for partition = 0, partitions - 1 do
+  local owner = key .. "/owner/" .. partition
+  if redis.call("get", owner) == member then
+    if #owned < share then
+      redis.call("pexpire", owner, ttl_ms)
+      owned[#owned + 1] = partition
+    else
+      redis.call("del", owner)
+    end
+  end
+end
+
+for partition = 0, partitions - 1 do
+  if #owned >= share then
+    break
+  end
+  if redis.call("set", key .. "/owner/" .. partition, member, "NX", "PX", ttl_ms) then
+    owned[#owned + 1] = partition
+  end
+end
+return owned
+"""
+
+# KEYS[1]: the partitioned queue's key
+# ARGV[1]: the member's ID, ARGV[2]: the number of partitions
+#
+# Releases every partition the member owns, and drops it from the members.
+_DISOWN_LUA = """
+redis.call("zrem", KEYS[1] .. "/members", ARGV[1])
+for partition = 0, tonumber(ARGV[2]) - 1 do
+  local owner = KEYS[1] .. "/owner/" .. partition
+  if redis.call("get", owner) == ARGV[1] then
+    redis.call("del", owner)
+  end
+end
+"""
+
+
+class _Scripts(object):
+  """Helper class.
+
+  The Lua scripts implementing queue operations, registered against a single connection. Every
+  scripted operation is exactly one round trip (an EVALSHA, falling back to loading the script), and
+  being atomic on the server needs no WATCH/retry loop no matter how contended the queue is.
+  """
+
+  _registry = WeakKeyDictionary()
+
+  def __init__(self, conn):
+    self.append = conn.register_script(_LUA_PRELUDE + _APPEND_LUA)
+    self.delay = conn.register_script(_DELAY_LUA)
+    self.claim = conn.register_script(_LUA_PRELUDE + _CLAIM_LUA)
+    self.claim_fetch = conn.register_script(_LUA_PRELUDE + _CLAIM_FETCH_LUA)
+    self.claim_batch = conn.register_script(_LUA_PRELUDE + _CLAIM_BATCH_LUA)
+    self.claim_lanes = conn.register_script(_LUA_PRELUDE + _CLAIM_LANES_LUA)
+    self.requeue = conn.register_script(_LUA_PRELUDE + _REQUEUE_LUA)
+    self.abort = conn.register_script(_ABORT_LUA)
+    self.release = conn.register_script(_RELEASE_LUA)
+    self.collect = conn.register_script(_LUA_PRELUDE + _COLLECT_LUA)
+    self.stats = conn.register_script(_LUA_PRELUDE + _STATS_LUA)
+    self.own = conn.register_script(_OWN_LUA)
+    self.disown = conn.register_script(_DISOWN_LUA)
+
+  @classmethod
+  def of(cls, conn):
+    """Get the scripts for a connection, registering them if this is the first use."""
+
+    scripts = cls._registry.get(conn)
+    if scripts is None:
+      scripts = cls._registry[conn] = cls(conn)
+    return scripts
 
 
 class _AppendSeq(object):
@@ -15,19 +567,43 @@ class _AppendSeq(object):
   Skrode needs atomic append, and constant time access to indexed sequence elements.
 
   This is implemented by using a single key to track the length of the list, and storing each
-  element of the list in its own key.
-
-  Deletion of elements from the list is not supported.
+  element of the list in its own key. Per-key overhead dwarfs small elements such as IDs, so with a
+  nonzero `chunk_size` elements are instead packed `chunk_size` to a hash, keyed by their offset
+  into the chunk. Keep `chunk_size` within Redis' `hash-max-ziplist-entries` so that chunks stay
+  compactly encoded. The layout of a list cannot change once it has been written to.
+
+  Elements cannot be deleted individually. Instead the list is divided into segments of
+  `segment_size` consecutive indices, and `collect` deletes whole segments from the front of the
+  list once every registered consumer is past them (or they exceed a max age or length). Indices
+  below the list's base have been collected, and are skipped by consumers.
   """
 
-  def __init__(self, conn, key, suffix="/"):
+  def __init__(self, conn, key, suffix="/", segment_size=1024, chunk_size=0, dedupe=None):
+    # Collection deletes whole segments, which must therefore be made of whole chunks.
+    assert not chunk_size or segment_size % chunk_size == 0
+
     self._conn = conn
     self._key = key
     self._suffix = suffix
+    self._segment_size = segment_size
+    self._chunk_size = chunk_size
+    self._dedupe = dedupe or 0
+    self._scripts = _Scripts.of(conn)
+    # Pub/sub channel on which the index of every push is published
+    self.channel = "%s/notify" % (key,)
 
   def __idx_key__(self, idx):
     return "%s%s%016x" % (self._key, self._suffix, idx)
 
+  def __chunk_key__(self, idx):
+    return "%s%schunk/%016x" % (self._key, self._suffix, idx // self._chunk_size)
+
+  def _layout(self):
+    """The leading script arguments describing how elements are stored and events counted."""
+
+    return [self._suffix, self._chunk_size, self._segment_size, _RATE_BUCKET,
+            max(_RATE_WINDOWS) + _RATE_BUCKET]
+
   def __len__(self):
     """Returns the length of the list.
 
@@ -39,52 +615,168 @@ class _AppendSeq(object):
     assert isinstance(idx, int)
 
     with self._conn.pipeline() as tx:
-      while True:
-        try:
-          tx.watch(self._key)
-          tx.watch(self.__idx_key__(idx))
+      tx.get(self._key)
+      tx.get("%s/base" % (self._key,))
+      if self._chunk_size:
+        tx.hget(self.__chunk_key__(idx), idx % self._chunk_size)
+      else:
+        tx.get(self.__idx_key__(idx))
+      max_idx, base, val = tx.execute()
 
-          max_idx = int(tx.get(self._key) or "0")
+    if int(base or "0") <= idx < int(max_idx or "0"):
+      return val
 
-          tx.multi()
+    raise IndexError()
 
-          if max_idx > idx:
-            tx.get(self.__idx_key__(idx))
-            return tx.execute()[0]
+  def read_range(self, start=None, end=None, batch=1024):
+    """Yield the `(index, value)` of every item in [start, end), by default every item which has
+    not been collected.
 
-          break
+    Indices are known, so no keys need be scanned. Items are read `batch` at a time, each batch in
+    a single pipelined round trip. Items collected during the read are skipped.
+    """
 
-        except WatchError:
-          continue
+    with self._conn.pipeline(transaction=False) as p:
+      p.get(self._key)
+      p.get("%s/base" % (self._key,))
+      length, base = [int(n or "0") for n in p.execute()]
+
+    start = base if start is None else max(start, base)
+    end = length if end is None else min(end, length)
+    for lo in range(start, end, batch):
+      hi = min(lo + batch, end)
+      if self._chunk_size:
+        with self._conn.pipeline(transaction=False) as p:
+          for chunk in range(lo - lo % self._chunk_size, hi, self._chunk_size):
+            p.hmget(self.__chunk_key__(chunk),
+                    [idx % self._chunk_size for idx in range(max(chunk, lo),
+                                                             min(chunk + self._chunk_size, hi))])
+          vals = [val for chunk_vals in p.execute() for val in chunk_vals]
+      else:
+        vals = self._conn.mget([self.__idx_key__(idx) for idx in range(lo, hi)])
+
+      for idx, val in zip(range(lo, hi), vals):
+        if val is not None:
+          yield idx, val
+
+  def push(self, val):
+    """
+    Atomically pushes the given value to the end of the list, returning its index or None if it was
+    dropped as a duplicate.
+    """
 
-        finally:
-          tx.reset()
+    idx, n = self._push([val], self._dedupe)
+    return idx if n else None
 
-    raise IndexError()
+  def push_many(self, vals, dedupe=True):
+    """
+    Atomically pushes all the given values to the end of the list, returning the index of the first.
 
-  def push(self, val):
+    Reserves `len(vals)` consecutive indices and writes every value in a single scripted round trip,
+    so the cost of a push is independent of the number of values pushed.
+
+    If the list has a `dedupe` window in seconds, values already pushed within that window are
+    dropped (unless `dedupe` is false), and the remaining values take consecutive indices. If every
+    value was dropped, returns None.
     """
-    Atomically pushes the given value to the end of the list.
+
+    idx, n = self._push(vals, self._dedupe if dedupe else 0)
+    return idx if n or not vals else None
+
+  def _push(self, vals, dedupe, client=None):
+    return self._scripts.append(keys=[self._key],
+                                args=self._layout() + [self.channel, time(), dedupe] + list(vals),
+                                client=client)
+
+  def push_later(self, vals, delay):
     """
+    Schedules the given values to be pushed once `delay` seconds have passed, returning how many
+    were scheduled.
 
-    with self._conn.pipeline() as tx:
-      while True:
-        try:
-          tx.watch(self._key)
-          next_idx = int(self._conn.get(self._key) or "0")
-          tx.multi()
-          self._conn.set(self.__idx_key__(next_idx), val)
-          # FIXME (arrdem 2018-01-03):
-          #   Could this be incr?
-          self._conn.set(self._key, next_idx + 1)
-          tx.execute()
-          return next_idx
-
-        except WatchError:
-          continue
+    Delayed values are held in a sorted set by due time, and pushed in due order by the first claim
+    after they fall due. They bypass deduplication.
+    """
+
+    return self._scripts.delay(keys=[self._key], args=[time() + delay] + list(vals))
+
+  def _delayed_key(self):
+    return "%s/delayed" % (self._key,)
 
-        finally:
-          tx.reset()
+  def collect(self, max_age=None, max_length=None, limit=64):
+    """Delete segments which every registered consumer has claimed past, returning how many items
+    were deleted.
+
+    Segments written more than `max_age` seconds ago, or holding items beyond the most recent
+    `max_length`, are deleted whether they have been consumed or not. At most `limit` segments are
+    deleted per call, so that collecting a large backlog doesn't block Redis.
+    """
+
+    return self._scripts.collect(keys=[self._key],
+                                 args=self._layout() + [time(),
+                                       "" if max_age is None else max_age,
+                                       "" if max_length is None else max_length,
+                                       limit])
+
+  def stats(self):
+    """Statistics of the list and its registered consumers, read in a single round trip.
+
+    Returns a dict of the `length` of the list, the total items ever `enqueued`, the
+    `enqueue_rate` in items per second over each rate window, the total `duplicates` dropped by
+    deduplication, the number of `delayed` items not yet due, the total items ever `dead_lettered`,
+    and `consumers`. Consumers maps each
+    registered consumer's ID to a dict of its `backlog` of unclaimed items, the number of items
+    `inflight` under lease, the `oldest_age` in seconds of its oldest unclaimed item (as of the
+    start of that item's segment, or None if there is no backlog), the total items ever `dequeued`
+    and the `dequeue_rate` in items per second over each rate window.
+    """
+
+    now = time()
+    return _parse_stats(self._scripts.stats(keys=[self._key], args=self._stats_args(now)), now)
+
+  def _stats_args(self, now):
+    newest = int(now // _RATE_BUCKET)
+    buckets = list(range(newest, newest - max(_RATE_WINDOWS) // _RATE_BUCKET, -1))
+    return [self._segment_size] + buckets
+
+
+def _parse_stats(result, now):
+  """Statistics from the result of the stats script. See `_AppendSeq.stats`."""
+
+  length, _base, enqueued, enqueue_buckets, duplicates, delayed, dead_lettered = result[:7]
+
+  consumers = {}
+  for consumer_id, cursor, inflight, written, dequeued, dequeue_buckets in result[7:]:
+    if isinstance(consumer_id, bytes):
+      consumer_id = consumer_id.decode("utf-8")
+    consumers[consumer_id] = {
+      "backlog": length - cursor,
+      "inflight": inflight,
+      "oldest_age": now - float(written) if written else None,
+      "dequeued": dequeued,
+      "dequeue_rate": _rates(dequeue_buckets),
+    }
+
+  return {
+    "length": length,
+    "enqueued": enqueued,
+    "enqueue_rate": _rates(enqueue_buckets),
+    "duplicates": duplicates,
+    "delayed": delayed,
+    "dead_lettered": dead_lettered,
+    "consumers": consumers,
+  }
+
+
+def _rates(buckets):
+  """Events per second over each rate window, given the counts of the buckets newest first."""
+
+  counts = [int(count or "0") for count in buckets]
+  return {window: sum(counts[:window // _RATE_BUCKET]) / float(window)
+          for window in _RATE_WINDOWS}
+
+
+# Sentinel for a WorkItem whose value has not been fetched yet.
+_MISSING = object()
 
 
 class WorkItem(object):
@@ -109,25 +801,54 @@ class WorkItem(object):
          sleep(5)
   """
 
-  def __init__(self, conn, key, list, idx, decoder=None):
-    self._conn = conn
-    self._key = key
-    self._list = list
+  def __init__(self, consumer, idx, raw=_MISSING):
+    self._consumer = consumer
     self._idx = idx
-    self._decoder = decoder or (lambda x: x)
+    self._raw = raw
 
   @property
   def value(self):
-    return self._decoder(self._list[self._idx])
+    if self._raw is _MISSING:
+      self._raw = self._consumer._list[self._idx]
+    return self._consumer._decoder(self._raw)
 
   def complete(self):
-    """FIXME: this is a no-op for now."""
-    pass
+    """Acknowledge that this work item has been processed, releasing its lease for good."""
 
-  def abort(self):
-    """Admit a failure to process this work item and put it back on the queue."""
+    leases = self._consumer._leases
+    with self._consumer._conn.pipeline() as tx:
+      tx.zrem(leases, self._idx)
+      tx.hdel("%s/attempts" % (leases,), self._idx)
+      tx.execute()
 
-    self._conn.set(self._key, self._idx)
+  def abort(self, retry_in=None):
+    """Admit a failure to process this work item and put it back on the queue.
+
+    The item's lease is expired, so the item is redelivered by the consumer's next claim. With a
+    `retry_in` delay in seconds (defaulting to the consumer's), redelivery is instead held off for
+    that long, doubling with every further delivery of the item up to the consumer's
+    `max_retry_delay`, and jittered down by up to half so that failures don't retry in lockstep.
+    """
+
+    if retry_in is None:
+      retry_in = self._consumer._retry_in
+    if not retry_in:
+      self._consumer._conn.execute_command("ZADD", self._consumer._leases, "XX", time(), self._idx)
+    else:
+      self._consumer._list._scripts.abort(
+        keys=[self._consumer._leases],
+        args=[self._idx, time(), retry_in, self._consumer._max_retry_delay, random()])
+
+  def extend(self):
+    """Renew this work item's lease for another visibility timeout from now."""
+
+    self._consumer._conn.execute_command("ZADD", self._consumer._leases, "XX",
+                                         time() + self._consumer._visibility_timeout, self._idx)
+
+  def release(self):
+    """Give up this work item unprocessed, to be redelivered without counting as an attempt."""
+
+    self._consumer._list._scripts.release(keys=[self._consumer._leases], args=[self._idx, time()])
 
   def __enter__(self):
     return self.value
@@ -151,85 +872,219 @@ class Producer(object):
   The queue is backed by a `BigList`
   """
 
-  def __init__(self, conn, key, encoder=None):
+  def __init__(self, conn, key, encoder=None, chunk_size=0, dedupe=None):
+    conn = resolve(conn, key)
     self._conn = conn
-    self._list = _AppendSeq(conn, key)
+    self._list = _AppendSeq(conn, key, chunk_size=chunk_size, dedupe=dedupe)
     self._encoder = encoder or (lambda x: x)
 
   def __len__(self):
     return len(self._list)
 
-  def put(self, value):
-    value = self._encoder(value)
-    return self._list.push(value)
+  def put(self, value, delay=None):
+    """Enqueue the value, returning its index (or None if it was a duplicate).
+
+    With a `delay` in seconds, the value is instead enqueued once the delay has passed, and None is
+    returned.
+    """
+
+    if delay:
+      self._list.push_later([self._encoder(value)], delay)
+      return None
+    return self._list.push(self._encoder(value))
+
+  def put_many(self, values, delay=None):
+    """Enqueue all of the given values in order, returning the index of the first (or None if every
+    value was a duplicate).
+
+    With a `delay` in seconds, the values are instead enqueued in order once the delay has passed,
+    and None is returned.
+    """
+
+    if delay:
+      self._list.push_later([self._encoder(value) for value in values], delay)
+      return None
+    return self._list.push_many([self._encoder(value) for value in values])
+
+  def stats(self):
+    """Enqueue statistics of the queue. See `_AppendSeq.stats`."""
+
+    stats = self._list.stats()
+    del stats["consumers"]
+    return stats
 
 
 class Consumer(object):
   """A helper type which represents a consumer over a durable FIFO queue.
 
-  Iterates over enqueued blobs as WorkItems, maintaining a durable index of the last WorkItem which
-  was acknowledged as completed. Maintains a persistent cursor in the backing Redis store tracking
-  the index of the last successfully consumed work item. If a work item fails to process, the cursor
-  is RESET to the index of the failed item. This leads to at least once processing of all records,
-  unless sufficient error handling is provided on the client side.
+  Iterates over enqueued blobs as WorkItems. Maintains a persistent cursor in the backing Redis
+  store tracking the index of the next unclaimed work item, and a lease set of the work items which
+  have been claimed but not yet completed, each with a deadline `visibility_timeout` seconds after
+  its claim.
 
+  Completing a work item removes its lease. Aborting a work item expires its lease, and a work item
+  whose lease expires - because it was aborted, or because the worker processing it died - is
+  redelivered by the next claim in preference to unclaimed items. Only those items are redelivered,
+  giving at least once processing of every record without replaying the work claimed after them.
+
+  Aborted work items are held off for `retry_in` seconds before redelivery, backing off
+  exponentially up to `max_retry_delay` seconds. See `WorkItem.abort`.
+
+  With `max_attempts`, a work item which has been delivered that many times without completing is
+  not redelivered again, but moved to the queue's dead letters (an ordinary queue at `<key>/dead`),
+  so that a poison item can't stall the consumer.
   """
 
-  def __init__(self, conn, key, consumer_id, decoder=None):
+  def __init__(self, conn, key, consumer_id, decoder=None, register=True, leases=None,
+               visibility_timeout=300, chunk_size=0, retry_in=0, max_retry_delay=3600,
+               max_attempts=None):
+    conn = resolve(conn, key)
     self._conn = conn
-    self._list = _AppendSeq(conn, key)
+    self._list = _AppendSeq(conn, key, chunk_size=chunk_size)
     self._key = consumer_id
-    self._decoder = decoder
+    self._leases = leases or "%s/leases" % (consumer_id,)
+    self._visibility_timeout = visibility_timeout
+    self._retry_in = retry_in
+    self._max_retry_delay = max_retry_delay
+    self._max_attempts = max_attempts or 0
+    self._decoder = decoder or (lambda x: x)
+    self._pubsub = None
+
+    if register:
+      # Registered consumers hold back collection of the items they have yet to claim or complete.
+      self._conn.hset("%s/consumers" % (key,), consumer_id, self._leases)
+
+  def unregister(self):
+    """Stop this consumer from holding back collection of the queue."""
+
+    self._conn.hdel("%s/consumers" % (self._list._key,), self._key)
 
   def __iter__(self):
     return self
 
+  def stats(self):
+    """Statistics of this consumer, or None if it isn't registered. See `_AppendSeq.stats`."""
+
+    return self._list.stats()["consumers"].get(self._key)
+
   def __len__(self):
-    with self._conn.pipeline() as tx:
-      while True:
-        try:
-          tx.watch(self._key)
-          tx.watch(self._list._key)
+    """The number of items this consumer has yet to claim."""
 
-          max_idx = int(tx.get(self._list._key) or "0")
-          cur_idx = int(tx.get(self._key) or "0")
+    max_idx, base, cur_idx = self._conn.mget(self._list._key, "%s/base" % (self._list._key,),
+                                             self._key)
+    return max(int(max_idx or "0") - max(int(cur_idx or "0"), int(base or "0")), 0)
 
-          return cur_idx - max_idx
+  def next(self, fetch=True, timeout=None, cancel=None):
+    """Claim the next WorkItem, raising StopIteration if there is none.
 
-        except WatchError:
-          continue
+    By default the item's value is fetched along with the claim. With `fetch=False` only the index
+    is claimed, and the value is read when (if ever) it is first accessed.
 
-        finally:
-          tx.reset()
+    If a `timeout` in seconds is given and the queue is empty, blocks for up to that long waiting to
+    be notified of a put. Waiting makes no calls against Redis, and wakes as soon as a producer puts
+    or a lease expires. Setting the `cancel` event, if given, cuts the wait short.
+    """
+
+    if timeout is None:
+      return self._claim(fetch)
+
+    deadline = time() + timeout
+    while True:
+      try:
+        return self._claim(fetch)
+      except StopIteration:
+        if deadline <= time() or (cancel is not None and cancel.is_set()):
+          raise
+
+        if self._pubsub is None:
+          # Subscribe and then check again, so that a put racing the subscription isn't missed.
+          self._pubsub = self._conn.pubsub(ignore_subscribe_messages=True)
+          self._pubsub.subscribe(*self._channels())
+          continue
 
-  def next(self):
+        # Wake no later than the next lease expiry or delayed item falling due, since either is
+        # claimable.
+        until = deadline
+        with self._conn.pipeline(transaction=False) as p:
+          for leases in self._wake_keys():
+            p.zrange(leases, 0, 0, withscores=True)
+          for earliest in p.execute():
+            for _, expiry in earliest:
+              until = min(until, max(expiry, time() + 0.01))
+
+        self._wait(until, cancel)
+
+  def _wait(self, until, cancel):
+    """Wait to be notified of a put until the given time, or until the `cancel` event is set."""
+
+    while True:
+      remaining = until - time()
+      if remaining <= 0 or (cancel is not None and cancel.is_set()):
+        return
+      if cancel is not None:
+        remaining = min(remaining, _CANCEL_POLL)
+
+      if self._pubsub.get_message(timeout=remaining) is not None:
+        # One claim attempt covers any number of puts, so drop the notifications already queued.
+        while self._pubsub.get_message() is not None:
+          pass
+        return
+
+  def _claim(self, fetch):
     # FIXME (arrdem 2018-01-02):
     #   when to throw StopIterationException?
 
-    with self._conn.pipeline() as tx:
-      while True:
-        try:
-          tx.watch(self._list._key)
-          tx.watch(self._key)
+    if not fetch:
+      idx = self._list._scripts.claim(keys=self._claim_keys(),
+                                      args=self._list._layout() + self._claim_args())
+      if idx is None:
+        raise StopIteration
+      return WorkItem(self, idx)
 
-          max_idx = int(tx.get(self._list._key) or "0")
-          cur_idx = int(tx.get(self._key) or "0")
+    claimed = self._list._scripts.claim_fetch(keys=self._claim_keys(),
+                                              args=self._list._layout() + self._claim_args())
+    if claimed is None:
+      raise StopIteration
 
-          if max_idx == cur_idx:
-            raise StopIteration
+    idx, raw = claimed[0], (claimed[1] if len(claimed) > 1 else None)
+    return WorkItem(self, idx, raw=raw)
 
-          else:
-            tx.multi()
-            tx.incr(self._key)
-            tx.execute()
-            return WorkItem(self._conn, self._key, self._list, cur_idx,
-                            decoder=self._decoder)
+  def _claim_keys(self):
+    return [self._list._key, self._key, self._leases]
 
-        except WatchError:
-          continue
+  def _channels(self):
+    return [self._list.channel]
+
+  def _wake_keys(self):
+    """Sorted sets scored by the times at which a claim may next succeed."""
+
+    return [self._leases, self._list._delayed_key()]
+
+  def _claim_args(self):
+    now = time()
+    return [now, now + self._visibility_timeout, self._max_attempts]
+
+  def close(self):
+    """Release the notification subscription, if `next` opened one."""
+
+    if self._pubsub is not None:
+      self._pubsub.close()
+      self._pubsub = None
 
-        finally:
-          tx.reset()
+  def next_batch(self, n):
+    """Claim up to `n` WorkItems at once, returning a possibly empty list of them.
+
+    Expired leases are reclaimed, the cursor is advanced and every claimed value is fetched in a
+    single round trip, so the returned WorkItems already hold their values.
+    """
+
+    claimed = self._list._scripts.claim_batch(keys=self._claim_keys(),
+                                              args=self._list._layout() + self._claim_args() + [n])
+    if claimed is None:
+      return []
+
+    idxs, raws = claimed
+    return [WorkItem(self, idx, raw=raw) for idx, raw in zip(idxs, raws)]
 
 
 class WorkQueue(object):
@@ -239,19 +1094,607 @@ class WorkQueue(object):
   clients.
   """
 
-  def __init__(self, conn, key, inflight=None, indirect=False, decoder=None, encoder=None):
+  def __init__(self, conn, key, inflight=None, indirect=False, decoder=None, encoder=None,
+               retention=None, visibility_timeout=300, chunk_size=0, dedupe=None, retry_in=0,
+               max_retry_delay=3600, max_attempts=None):
+    conn = resolve(conn, key)
+    self._conn = conn
+    self._producer = Producer(conn, key, encoder=encoder, chunk_size=chunk_size, dedupe=dedupe)
+    self._consumer = Consumer(conn, key, "%s/implicit_consumer" % (key,), decoder=decoder,
+                              leases=inflight, visibility_timeout=visibility_timeout,
+                              chunk_size=chunk_size, retry_in=retry_in,
+                              max_retry_delay=max_retry_delay, max_attempts=max_attempts)
+    # Keep the mapping given, even empty, rather than a new one, so that it stays the queue's.
+    self._retention = retention if retention is not None else {}
+    self._chunk_size = chunk_size
+
+  def __len__(self):
+    return len(self._consumer)
+
+  def put(self, val, delay=None):
+    return self._producer.put(val, delay=delay)
+
+  def put_many(self, vals, delay=None):
+    return self._producer.put_many(vals, delay=delay)
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting for an item to be put, or until
+    the `cancel` event is set.
+    """
+
+    try:
+      return self._consumer.next(timeout=timeout, cancel=cancel)
+    except StopIteration:
+      return None
+
+  def get_many(self, n):
+    return self._consumer.next_batch(n)
+
+  def stats(self):
+    """Statistics of the queue and every consumer registered on it. See `_AppendSeq.stats`.
+
+    Cheap enough to poll every second.
+    """
+
+    return self._producer._list.stats()
+
+  def collect(self):
+    """Collect consumed segments of the queue, subject to its `retention` settings (`max_age` in
+    seconds and `max_length`), returning how many items were deleted.
+    """
+
+    deleted = 0
+    while True:
+      n = self._producer._list.collect(**self._retention)
+      if not n:
+        return deleted
+      deleted += n
+
+  def dead_letters(self):
+    """The queue of this queue's dead letters, holding their raw undecoded values."""
+
+    return WorkQueue(self._conn, "%s/dead" % (self._producer._list._key,),
+                     chunk_size=self._chunk_size)
+
+  def requeue_dead(self, n=None):
+    """Move up to `n` (by default all) dead letters back to the end of this queue, with fresh
+    attempt counts, returning how many were moved.
+    """
+
+    seq = self._producer._list
+    dead = self.dead_letters()._consumer
+    moved = 0
+    while n is None or moved < n:
+      requeued = seq._scripts.requeue(
+        keys=[seq._key] + dead._claim_keys(),
+        args=seq._layout() + dead._claim_args() + [1024 if n is None else min(n - moved, 1024),
+                                                   seq.channel])
+      if not requeued:
+        break
+      moved += requeued
+    self.dead_letters().collect()
+    return moved
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._producer._list._key)
+
+
+class PriorityConsumer(Consumer):
+  """A consumer over the lanes of a priority queue, each of which is an ordinary queue consumed by
+  the given lane consumers.
+
+  With the `strict` strategy, every claim drains the lanes in order, so an item is only claimed from
+  a lane once every lane before it is empty. With the `weighted` strategy, claims start from each
+  lane in proportion to its weight (by smooth weighted round robin) and then drain the rest in
+  order, so lower lanes are never starved yet no lane idles while there is work.
+
+  Claims from any number of lanes are a single round trip.
+  """
+
+  def __init__(self, conn, lanes, weights=None, strategy="weighted"):
+    assert strategy in ("strict", "weighted")
+
+    # Deliberately not calling Consumer.__init__, this consumer has no queue of its own.
     self._conn = conn
-    self._producer = Producer(conn, key, encoder=encoder)
-    self._consumer = Consumer(conn, key, "%s/implicit_consumer" % (key,), decoder=decoder)
+    self._lanes = lanes
+    self._weights = weights or [1] * len(lanes)
+    self._strategy = strategy
+    self._credits = [0] * len(lanes)
+    self._pubsub = None
+
+  def _order(self):
+    """The lanes in the order the next claim should drain them."""
+
+    order = list(range(len(self._lanes)))
+    if self._strategy == "weighted":
+      for lane, weight in enumerate(self._weights):
+        self._credits[lane] += weight
+      first = max(order, key=lambda lane: self._credits[lane])
+      self._credits[first] -= sum(self._weights)
+      order.remove(first)
+      order.insert(0, first)
+    return order
+
+  def next_batch(self, n):
+    """Claim up to `n` WorkItems at once across the lanes, returning a possibly empty list."""
+
+    order = self._order()
+    lanes = [self._lanes[lane] for lane in order]
+    keys = [key for lane in lanes for key in lane._claim_keys()]
+    claimed = lanes[0]._list._scripts.claim_lanes(
+      keys=keys, args=lanes[0]._list._layout() + lanes[0]._claim_args() + [n])
+
+    return [WorkItem(lanes[lane], idx, raw=raw)
+            for lane, idxs, raws in claimed
+            for idx, raw in zip(idxs, raws)]
+
+  def _claim(self, fetch):
+    items = self.next_batch(1)
+    if not items:
+      raise StopIteration
+    return items[0]
+
+  def _channels(self):
+    return [lane._list.channel for lane in self._lanes]
+
+  def _wake_keys(self):
+    return [key for lane in self._lanes for key in lane._wake_keys()]
+
+  def __len__(self):
+    return sum(len(lane) for lane in self._lanes)
+
+  def unregister(self):
+    for lane in self._lanes:
+      lane.unregister()
+
+  def stats(self):
+    return [lane.stats() for lane in self._lanes]
+
+
+class PriorityWorkQueue(object):
+  """A queue of several lanes, each an ordinary queue at `<key>/lane/<name>`, drained by priority.
+
+  Producers choose the lane of every put, defaulting to `default_lane` or else the first lane. The
+  `WorkQueue` API is provided over the lanes, consuming as a :py:class:`PriorityConsumer` with the
+  given lane `weights` and `strategy`. Every other option applies to each lane.
+
+  .. code-block:: python
+
+     queue = PriorityWorkQueue(conn, "/queue/twitter/tweet_ids", lanes=["live", "backfill"],
+                               weights=[9, 1])
+     queue.put(tweet_id)                     # to the live lane
+     queue.put(old_tweet_id, lane="backfill")
+     queue.lane("backfill").put_many(old_tweet_ids)
+  """
+
+  def __init__(self, conn, key, lanes, weights=None, strategy="weighted", default_lane=None,
+               inflight=None, **kwargs):
+    # Lanes are claimed from together, so are all placed on the node of the queue's key.
+    conn = resolve(conn, key)
+    self._key = key
+    self._names = list(lanes)
+    self._lanes = {name: WorkQueue(conn, "%s/lane/%s" % (key, name),
+                                   inflight=inflight and "%s/%s" % (inflight, name),
+                                   **kwargs)
+                   for name in self._names}
+    self._default_lane = default_lane or self._names[0]
+    self._consumer = PriorityConsumer(conn, [self._lanes[name]._consumer for name in self._names],
+                                      weights=weights, strategy=strategy)
+
+  def lane(self, name):
+    """The queue of the named lane, to which puts go directly."""
+
+    return self._lanes[name]
 
   def __len__(self):
     return len(self._consumer)
 
-  def put(self, val):
-    return self._producer.put(val)
+  def put(self, val, lane=None, delay=None):
+    return self._lanes[lane or self._default_lane].put(val, delay=delay)
+
+  def put_many(self, vals, lane=None, delay=None):
+    return self._lanes[lane or self._default_lane].put_many(vals, delay=delay)
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem from the lanes by priority, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting for an item to be put, or until
+    the `cancel` event is set.
+    """
 
-  def get(self):
     try:
-      return self._consumer.next()
+      return self._consumer.next(timeout=timeout, cancel=cancel)
     except StopIteration:
       return None
+
+  def get_many(self, n):
+    return self._consumer.next_batch(n)
+
+  def stats(self):
+    """Statistics of each lane, by lane name. See `_AppendSeq.stats`."""
+
+    return {name: self._lanes[name].stats() for name in self._names}
+
+  def collect(self):
+    """Collect consumed segments of every lane, returning how many items were deleted."""
+
+    return sum(self._lanes[name].collect() for name in self._names)
+
+  def dead_letters(self):
+    """The queue of each lane's dead letters, by lane name."""
+
+    return {name: self._lanes[name].dead_letters() for name in self._names}
+
+  def requeue_dead(self, n=None):
+    """Move up to `n` (by default all) dead letters back to their lanes, returning how many were
+    moved.
+    """
+
+    moved = 0
+    for name in self._names:
+      moved += self._lanes[name].requeue_dead(None if n is None else n - moved)
+    return moved
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._key)
+
+
+class PartitionedWorkQueue(object):
+  """A queue of several partitions, each an ordinary queue at `<key>/partition/<n>`, between which
+  values are routed by key.
+
+  Every value is put to the partition of its routing key - by default the value itself, else the
+  result of calling `route` on the value - so all the values of one key go to the same partition in
+  order. Each partition is consumed by one process at a time, so values of the same key are never
+  processed concurrently, and are processed in order except for retries.
+
+  Consuming processes share out the partitions between them, each owning up to the number of
+  partitions divided by the number of live consumers. Ownership is heartbeat by every claim, at
+  most every third of `ownership_ttl` seconds, and lapses when a consumer stops claiming for the
+  TTL, whereupon the remaining consumers take over its partitions. A consumer stops claiming from a
+  partition as soon as it loses it, but the new owner only starts once every item claimed from the
+  partition has been completed, released or had its lease expire, so a partition changing hands is
+  never consumed by two processes at once. Ownership is timed by `clock`, by default `time.time`.
+
+  Every other option applies to each partition. Given a
+  :py:class:`skrode.redis.cluster.RedisCluster`, each partition is placed on its own node, and
+  claims are made from the owned partitions of each node in turn.
+
+  .. code-block:: python
+
+     queue = PartitionedWorkQueue(conn, "/queue/twitter/user_ids", partitions=16)
+     queue.put(user_id)
+     with queue.get() as user_id:
+       # ... no other consumer is processing this user
+  """
+
+  def __init__(self, conn, key, partitions, route=None, inflight=None, ownership_ttl=30,
+               clock=time, **kwargs):
+    self._conn = resolve(conn, key)
+    self._key = key
+    self._route = route or (lambda x: x)
+    self._ownership_ttl = ownership_ttl
+    self._clock = clock
+    self._partitions = [WorkQueue(conn, "%s/partition/%d" % (key, partition),
+                                  inflight=inflight and "%s/%d" % (inflight, partition),
+                                  **kwargs)
+                        for partition in range(partitions)]
+    self._scripts = _Scripts.of(self._conn)
+    self._member = None
+    self._owned = None
+    self._ready = []
+    self._consumers = []
+    self._heartbeat = 0
+
+  def partition(self, partition):
+    """The queue of the numbered partition."""
+
+    return self._partitions[partition]
+
+  def routing_key(self, val):
+    """The routing key of a value, as bytes."""
+
+    routing_key = self._route(val)
+    if not isinstance(routing_key, bytes):
+      routing_key = str(routing_key).encode("utf-8")
+    return routing_key
+
+  def partition_of(self, routing_key):
+    """The number of the partition values with the given routing key are put to."""
+
+    if not isinstance(routing_key, bytes):
+      routing_key = str(routing_key).encode("utf-8")
+    return crc32(routing_key) % len(self._partitions)
+
+  def __len__(self):
+    return sum(len(partition) for partition in self._partitions)
+
+  def put(self, val, delay=None):
+    return self._partitions[self.partition_of(self._route(val))].put(val, delay=delay)
+
+  def put_many(self, vals, delay=None):
+    """Enqueue all of the given values, each to the partition of its key, in one put per partition.
+
+    Returns nothing, since the values don't share a sequence of indices.
+    """
+
+    routed = {}
+    for val in vals:
+      routed.setdefault(self.partition_of(self._route(val)), []).append(val)
+    for partition, partition_vals in routed.items():
+      self._partitions[partition].put_many(partition_vals, delay=delay)
+
+  def _member_id(self):
+    # Processes are forked with queues already constructed, so each process takes a fresh ID.
+    if self._member is None or self._member[0] != os.getpid():
+      self._member = (os.getpid(), "%s/%d/%s" % (socket.gethostname(), os.getpid(), uuid4().hex))
+      self._owned, self._ready, self._consumers = None, [], []
+    return self._member[1]
+
+  def _drained(self, partition):
+    # Whether no item claimed from the partition is still under an unexpired lease.
+    consumer = self._partitions[partition]._consumer
+    return not consumer._conn.zcount(consumer._leases, "(%f" % (time(),), "+inf")
+
+  def owned(self):
+    """The numbers of the partitions this process owns and consumes, heartbeating and rebalancing
+    if due. A partition taken over from another consumer is left out until it has drained.
+    """
+
+    member = self._member_id()
+    now = self._clock()
+    if self._owned is None or now - self._heartbeat >= self._ownership_ttl / 3.0:
+      owned = sorted(self._scripts.own(keys=[self._key],
+                                       args=[member, now, self._ownership_ttl,
+                                             len(self._partitions)]))
+      self._heartbeat = now
+      if owned != self._owned:
+        log.info("%r now owns partitions %r", self, owned)
+        self._owned = owned
+
+      ready = [partition for partition in owned
+               if partition in self._ready or self._drained(partition)]
+      if ready != self._ready:
+        self._close_consumers()
+        self._ready = ready
+
+        # Claims are scripted against one node at a time, so partitions are consumed per node.
+        by_node = OrderedDict()
+        for partition in ready:
+          queue = self._partitions[partition]
+          by_node.setdefault(id(queue._conn), (queue._conn, []))[1].append(queue._consumer)
+        self._consumers = [PriorityConsumer(node, consumers)
+                           for node, consumers in by_node.values()]
+    return self._ready
+
+  def _close_consumers(self):
+    for consumer in self._consumers:
+      consumer.close()
+    self._consumers = []
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem from the owned partitions, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting for an item to be put, or until
+    the `cancel` event is set. Consuming no partitions, waits for up to the timeout before
+    rebalancing.
+    """
+
+    if not self.owned():
+      if timeout:
+        wait = min(timeout, self._ownership_ttl / 3.0)
+        if cancel is not None:
+          cancel.wait(wait)
+        else:
+          sleep(wait)
+      return None
+
+    # Try every node before blocking on each in turn for its share of the timeout.
+    shares = [None]
+    if timeout:
+      shares.append(min(timeout, self._ownership_ttl / 3.0) / len(self._consumers))
+    for share in shares:
+      for consumer in self._consumers:
+        try:
+          return consumer.next(timeout=share, cancel=cancel)
+        except StopIteration:
+          pass
+    return None
+
+  def get_many(self, n):
+    items = []
+    if self.owned():
+      for consumer in self._consumers:
+        if len(items) < n:
+          items.extend(consumer.next_batch(n - len(items)))
+    return items
+
+  def release(self):
+    """Give up this process' partitions to the other consumers."""
+
+    if self._member is not None and self._member[0] == os.getpid():
+      self._scripts.disown(keys=[self._key], args=[self._member[1], len(self._partitions)])
+      self._close_consumers()
+    self._member = self._owned = None
+    self._ready, self._consumers = [], []
+
+  def stats(self):
+    """Statistics of each partition, by partition number. See `_AppendSeq.stats`."""
+
+    return [partition.stats() for partition in self._partitions]
+
+  def collect(self):
+    """Collect consumed segments of every partition, returning how many items were deleted."""
+
+    return sum(partition.collect() for partition in self._partitions)
+
+  def dead_letters(self):
+    """The queue of each partition's dead letters, by partition number."""
+
+    return {number: partition.dead_letters() for number, partition in enumerate(self._partitions)}
+
+  def requeue_dead(self, n=None):
+    """Move up to `n` (by default all) dead letters back to their partitions, returning how many
+    were moved.
+    """
+
+    moved = 0
+    for partition in self._partitions:
+      moved += partition.requeue_dead(None if n is None else n - moved)
+    return moved
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._key)
+
+
+class PrefetchingQueue(object):
+  """Wraps a queue, claiming items ahead of their use so that `get` needn't wait on Redis.
+
+  A background thread keeps a buffer of up to `size` claimed items, claiming `batch` at a time and
+  waiting on the queue for up to `poll` seconds when it is empty. Buffered items are held under
+  lease, so the thread renews the lease of every item which has been buffered for `extend_after`
+  seconds - keep that well within the queue's visibility timeout. Closing the queue releases the
+  items still buffered, to be redelivered without counting as attempts.
+
+  Items are completed and aborted as usual, and every other method is the wrapped queue's.
+
+  .. code-block:: python
+
+     queue = PrefetchingQueue(WorkQueue(conn, "/queue/twitter/tweet_ids/ready"), size=64)
+     try:
+       while True:
+         with queue.get(timeout=5) as tweet_id:
+           # ...
+     finally:
+       queue.close()
+  """
+
+  def __init__(self, queue, size=64, batch=None, poll=1, extend_after=60):
+    self._queue = queue
+    self._size = size
+    self._batch = batch or max(size // 4, 1)
+    self._poll = poll
+    self._extend_after = extend_after
+    self._buffer = deque()
+    self._cond = threading.Condition()
+    self._closed = threading.Event()
+    self._thread = None
+
+  def _ensure_started(self):
+    # Started on first use rather than construction, so that a forked process starts its own.
+    if self._thread is None or self._thread[0] != os.getpid():
+      thread = threading.Thread(target=self._fill, name="prefetch %r" % (self._queue,))
+      thread.daemon = True
+      self._buffer.clear()
+      self._thread = (os.getpid(), thread)
+      thread.start()
+
+  def _fill(self):
+    while True:
+      with self._cond:
+        if len(self._buffer) >= self._size and not self._closed.is_set():
+          self._cond.wait(self._extend_after / 2.0)
+        if self._closed.is_set():
+          return
+        stale = self._stale()
+        wanted = self._size - len(self._buffer)
+
+      # Leases are renewed outside the lock, so that `get` needn't wait on their round trips.
+      for item in stale:
+        item.extend()
+      if not wanted:
+        continue
+
+      try:
+        items = self._queue.get_many(min(wanted, self._batch))
+        if not items:
+          item = self._queue.get(timeout=self._poll, cancel=self._closed)
+          items = [item] if item is not None else []
+      except Exception:
+        log.exception("Failed to prefetch from %r", self._queue)
+        items = []
+        sleep(self._poll)
+
+      with self._cond:
+        now = time()
+        self._buffer.extend([now, item] for item in items)
+        self._cond.notify_all()
+
+  def _stale(self):
+    # The buffered items due a lease renewal, marked as renewed.
+    now = time()
+    stale = []
+    for buffered in self._buffer:
+      if now - buffered[0] >= self._extend_after:
+        buffered[0] = now
+        stale.append(buffered[1])
+    return stale
+
+  def __len__(self):
+    return len(self._queue) + len(self._buffer)
+
+  def put(self, val, **kwargs):
+    return self._queue.put(val, **kwargs)
+
+  def put_many(self, vals, **kwargs):
+    return self._queue.put_many(vals, **kwargs)
+
+  def get(self, timeout=None, cancel=None):
+    """Get the next WorkItem, or None if there is none.
+
+    With a `timeout` in seconds, blocks for up to that long waiting for an item to be prefetched, or
+    until the `cancel` event is set.
+    """
+
+    self._ensure_started()
+    deadline = time() + (timeout or 0)
+    with self._cond:
+      while not self._buffer:
+        remaining = deadline - time()
+        if remaining <= 0 or self._closed.is_set() or (cancel is not None and cancel.is_set()):
+          return None
+        self._cond.wait(remaining if cancel is None else min(remaining, _CANCEL_POLL))
+      item = self._buffer.popleft()[1]
+      self._cond.notify_all()
+      return item
+
+  def get_many(self, n):
+    self._ensure_started()
+    with self._cond:
+      items = [self._buffer.popleft()[1] for _ in range(min(n, len(self._buffer)))]
+      self._cond.notify_all()
+      return items
+
+  def close(self):
+    """Stop prefetching, and release the items still buffered."""
+
+    with self._cond:
+      self._closed.set()
+      self._cond.notify_all()
+    if self._thread is not None and self._thread[0] == os.getpid():
+      self._thread[1].join()
+    while self._buffer:
+      self._buffer.popleft()[1].release()
+
+  def __getattr__(self, name):
+    return getattr(self._queue, name)
+
+  def __repr__(self):
+    return "<%s %r>" % (type(self).__name__, self._queue)
+
+
+def collect_queues(event, queues, interval=60):
+  """Custom worker.
+
+  Periodically collects the consumed segments of each of the given queues, until the event becomes
+  set.
+  """
+
+  while not event.is_set():
+    for queue in queues:
+      deleted = queue.collect()
+      if deleted:
+        log.info("Collected %d items from %r", deleted, queue)
+    event.wait(interval)
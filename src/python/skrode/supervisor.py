@@ -0,0 +1,108 @@
+"""
+Supervising the restarts of worker processes.
+"""
+
+from collections import deque
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+  """The restart history of a worker, holding off restarts of a worker which keeps crashing.
+
+  A replica which exits within `stable_after` seconds of starting has crashed, and its restart is
+  delayed by `backoff` seconds, doubling with every crash in a row up to `max_backoff`. After
+  `threshold` crashes in a row the breaker is open, holding every restart of the worker until
+  `max_backoff` seconds after the last crash. Then a single trial replica is started, and the
+  breaker is half-open, holding every other restart, until that replica either crashes, reopening
+  the breaker, or runs for `stable_after` seconds, closing it and forgetting the crashes.
+
+  The start and exit times of the last `history` exits are kept to be reported.
+  """
+
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"
+
+  def __init__(self, name, backoff=1, max_backoff=300, threshold=3, stable_after=60, history=16):
+    self.name = name
+    self.state = self.CLOSED
+    self.crashes = 0
+    self.restarts = 0
+    # The (start, exit) times of the worker's most recent exits
+    self.history = deque(maxlen=history)
+    self._backoff = backoff
+    self._max_backoff = max_backoff
+    self._threshold = threshold
+    self._stable_after = stable_after
+    self._started = {}
+    self._last_crash = None
+    self._trial = None
+
+  def _transition(self, state):
+    if state == self.state:
+      return
+    log.log({self.CLOSED: logging.INFO, self.HALF_OPEN: logging.WARNING}.get(state, logging.ERROR),
+            "Circuit breaker of worker %r is %s after %d crashes in a row",
+            self.name, state, self.crashes)
+    self.state = state
+
+  def started(self, pid, now):
+    """Record the start of a replica."""
+
+    self._started[pid] = now
+    if self.state == self.OPEN:
+      self._trial = pid
+      self._transition(self.HALF_OPEN)
+
+  def retired(self, pid):
+    """Forget a replica which was retired rather than having exited by itself."""
+
+    self._started.pop(pid, None)
+    if self.state == self.HALF_OPEN and pid == self._trial:
+      # The trial proved nothing, so another is due at once
+      self._transition(self.OPEN)
+
+  def held_until(self, now):
+    """The time until which restarts of the worker are held, or None if a replica may start now."""
+
+    if self.state == self.OPEN and now < self._last_crash + self._max_backoff:
+      return self._last_crash + self._max_backoff
+    elif self.state == self.HALF_OPEN:
+      return max(self._started.get(self._trial, now) + self._stable_after, now)
+    return None
+
+  def exited(self, pid, now):
+    """Record the exit of a replica, returning how long in seconds to wait before restarting it."""
+
+    started = self._started.pop(pid, now)
+    self.history.append((started, now))
+    self.restarts += 1
+
+    if now - started >= self._stable_after:
+      self._transition(self.CLOSED)
+      self.crashes = 0
+      return 0
+
+    self.crashes += 1
+    self._last_crash = now
+    if self.crashes >= self._threshold:
+      self._transition(self.OPEN)
+    return min(self._backoff * 2 ** min(self.crashes - 1, 32), self._max_backoff)
+
+  def poll(self, now):
+    """Forget the crashes once a replica started since the last of them has been up for
+    `stable_after` seconds.
+    """
+
+    if self.crashes and any(started >= self._last_crash and now - started >= self._stable_after
+                            for started in self._started.values()):
+      self._transition(self.CLOSED)
+      self.crashes = 0
+
+  def __str__(self):
+    uptimes = ", ".join("%ds" % (exit - start,) for start, exit in reversed(self.history))
+    return "circuit %s, %d crashes in a row, %d restarts, last exits after %s" % (
+      self.state, self.crashes, self.restarts, uptimes or "none")
@@ -0,0 +1,67 @@
+from json import dumps, loads
+from multiprocessing import Process
+
+from skrode.local.workqueue import Consumer, Producer, QueueFull, WorkQueue
+
+from pytest import fixture, raises
+
+
+@fixture
+def path(tmpdir):
+  return str(tmpdir.join("queue"))
+
+
+def test_produce_consume(path):
+  source = Producer(path, encoder=dumps, capacity=4096)
+  sink0 = Consumer(path, "test_key_consumer_0", decoder=loads, capacity=4096)
+  sink1 = Consumer(path, "test_key_consumer_1", decoder=loads, capacity=4096)
+
+  # Enough records to wrap around the ring several times
+  for i in range(1, 1000):
+    source.put(i)
+    with sink0.next() as next_value0:
+      with sink1.next() as next_value1:
+        assert i == next_value0 == next_value1
+
+  assert len(sink0) == len(sink1) == 0
+  assert len(source) == len(range(1, 1000))
+
+
+def test_abort_redelivers(path):
+  queue = WorkQueue(path, encoder=dumps, decoder=loads)
+  queue.put_many(["a", "b"])
+
+  with raises(RuntimeError):
+    with queue.get() as value:
+      assert value == "a"
+      raise RuntimeError()
+
+  assert [item.value for item in queue.get_many(5)] == ["a", "b"]
+  assert queue.get(timeout=0.05) is None
+
+
+def test_full(path):
+  source = Producer(path, capacity=64)
+  with raises(QueueFull):
+    source.put(b"x" * 128)
+
+
+def _produce(path, start):
+  WorkQueue(path, encoder=dumps, capacity=4096).put_many(range(start, start + 500))
+
+
+def test_across_processes(path):
+  queue = WorkQueue(path, encoder=dumps, decoder=loads, capacity=4096)
+  producers = [Process(target=_produce, args=(path, start)) for start in (0, 500)]
+  for producer in producers:
+    producer.start()
+
+  seen = []
+  while len(seen) < 1000:
+    item = queue.get(timeout=5)
+    assert item is not None
+    seen.append(item.value)
+
+  for producer in producers:
+    producer.join()
+  assert sorted(seen) == list(range(0, 1000))
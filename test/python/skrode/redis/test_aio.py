@@ -0,0 +1,75 @@
+import asyncio
+from json import dumps, loads
+
+from skrode.redis import aio
+from skrode.redis.workqueue import WorkQueue
+
+from redis import StrictRedis
+from redis.asyncio import StrictRedis as AsyncRedis
+from pytest import fixture
+
+
+@fixture
+def conn():
+  rds = StrictRedis("localhost", db=15)
+  rds.flushdb()
+  return rds
+
+
+@fixture
+def loop():
+  loop = asyncio.new_event_loop()
+  yield loop
+  loop.close()
+
+
+@fixture
+def aconn(loop):
+  rds = AsyncRedis(host="localhost", db=15)
+  yield rds
+  loop.run_until_complete(rds.aclose())
+
+
+def test_produce_consume(conn, loop, aconn):
+  async def _test():
+    queue = aio.WorkQueue(aconn, "test_key", encoder=dumps, decoder=loads)
+    assert await queue.put(0) == 0
+    assert await queue.put_many(range(1, 10)) == 1
+    assert await queue.length() == 10
+
+    async with await queue.get() as value:
+      assert value == 0
+    items = await queue.get_many(20)
+    assert [item.value for item in items] == list(range(1, 10))
+    await asyncio.gather(*[item.complete() for item in items])
+    assert await queue.get() is None
+    assert (await queue.stats())["consumers"]["test_key/implicit_consumer"]["inflight"] == 0
+    await queue.close()
+
+  loop.run_until_complete(_test())
+
+
+def test_blocking_get(conn, loop, aconn):
+  async def _test():
+    queue = aio.WorkQueue(aconn, "test_key", encoder=dumps, decoder=loads)
+    waiting = asyncio.ensure_future(queue.get(timeout=2))
+    await asyncio.sleep(0.2)
+    await queue.put(1)
+    assert (await waiting).value == 1
+    await queue.close()
+
+  loop.run_until_complete(_test())
+
+
+def test_interop(conn, loop, aconn):
+  # The blocking and asyncio queues share a layout, and so can be used on either end of a queue
+  WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, chunk_size=128).put_many([1, 2])
+
+  async def _test():
+    queue = aio.WorkQueue(aconn, "test_key", encoder=dumps, decoder=loads, chunk_size=128)
+    item = await queue.get()
+    await item.abort()
+    assert [item.value for item in await queue.get_many(2)] == [1, 2]
+    await queue.close()
+
+  loop.run_until_complete(_test())
@@ -0,0 +1,51 @@
+from json import dumps, loads
+
+from skrode.redis.cluster import RedisCluster
+from skrode.redis.workqueue import PartitionedWorkQueue, WorkQueue
+
+from redis import StrictRedis
+from pytest import fixture
+
+
+@fixture
+def cluster():
+  nodes = [StrictRedis("localhost", db=db) for db in (13, 14, 15)]
+  for node in nodes:
+    node.flushdb()
+  return RedisCluster(nodes)
+
+
+def test_placement(cluster):
+  keys = ["/queue/%d" % (n,) for n in range(0, 3000)]
+  placed = [cluster.node_for(key) for key in keys]
+
+  # Keys are spread over every node, stably
+  for node in cluster.nodes:
+    assert 500 < placed.count(node) < 1500
+  assert placed == [cluster.node_for(key) for key in keys]
+
+  # Dropping a node only moves that node's keys
+  smaller = RedisCluster(cluster.nodes[:2])
+  for key, node in zip(keys, placed):
+    if node is not cluster.nodes[2]:
+      assert smaller.node_for(key) is node
+
+
+def test_queue_placement(cluster):
+  queue = WorkQueue(cluster, "test_key", encoder=dumps, decoder=loads)
+  queue.put_many(range(0, 10))
+
+  node = cluster.node_for("test_key")
+  assert int(node.get("test_key")) == 10
+  assert all(other.get("test_key") is None for other in cluster.nodes if other is not node)
+  assert [item.value for item in queue.get_many(10)] == list(range(0, 10))
+
+
+def test_partition_placement(cluster):
+  queue = PartitionedWorkQueue(cluster, "test_key", partitions=8, encoder=dumps, decoder=loads)
+  queue.put_many(range(0, 100))
+
+  # Partitions land on several nodes, and are all consumed
+  assert len(set(id(queue.partition(n)._conn) for n in range(0, 8))) > 1
+  assert sorted(item.value for item in queue.get_many(100)) == list(range(0, 100))
+  assert queue.get(timeout=0.1) is None
@@ -0,0 +1,27 @@
+from skrode.redis.codec import make_codec
+
+from pytest import mark, raises
+
+
+@mark.parametrize("codec,compress,value", [
+  ("json", False, {"id": 1, "text": "hello"}),
+  ("json", True, {"id": 1, "text": "hello " * 100}),
+  ("msgpack", False, {"id": 1, "text": "hello"}),
+  ("msgpack", 9, [1, "two", None]),
+  ("uint64", False, 957380475049054208),
+])
+def test_round_trip(codec, compress, value):
+  encode, decode = make_codec(codec, compress=compress)
+  blob = encode(value)
+  assert decode(blob if isinstance(blob, bytes) else blob.encode("utf-8")) == value
+
+
+def test_uint64_ids():
+  encode, decode = make_codec("uint64")
+  assert len(encode("957380475049054208")) == 8
+  assert decode(encode("957380475049054208")) == 957380475049054208
+
+
+def test_unknown_codec():
+  with raises(ValueError):
+    make_codec("pickle")
@@ -1,10 +1,12 @@
 from json import dumps, loads
-from threading import Thread, Event
+from threading import Event, Thread, Timer
+from time import time
 
-from skrode.redis.workqueue import Producer, Consumer
+from skrode.redis.workqueue import (Consumer, PartitionedWorkQueue, PrefetchingQueue,
+                                    PriorityWorkQueue, Producer, WorkQueue)
 
 from redis import StrictRedis
-from pytest import fixture
+from pytest import fixture, raises
 
 @fixture
 def conn():
@@ -27,3 +29,337 @@ def test_produce_consume(conn):
 
   assert len(sink0) == len(sink1) == 0
   assert len(source) == len(range(1, 100))
+
+
+def test_put_many(conn):
+  source = Producer(conn, "test_key", encoder=dumps)
+  sink = Consumer(conn, "test_key", "test_key_consumer", decoder=loads)
+
+  assert source.put(0) == 0
+  assert source.put_many(range(1, 100)) == 1
+  assert source.put_many([]) == 100
+  assert len(source) == 100
+
+  for i in range(0, 100):
+    with sink.next() as value:
+      assert i == value
+
+
+def test_contended_claims(conn):
+  source = Producer(conn, "test_key", encoder=dumps)
+  seen = []
+
+  def _drain():
+    # Every thread shares a single consumer ID, and so competes for the same items
+    sink = Consumer(conn, "test_key", "test_key_consumer", decoder=loads)
+    while True:
+      try:
+        item = sink.next(fetch=len(seen) % 2 == 0)
+      except StopIteration:
+        return
+      with item as value:
+        seen.append(value)
+
+  source.put_many(range(0, 500))
+  workers = [Thread(target=_drain) for _ in range(0, 4)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+
+  assert sorted(seen) == list(range(0, 500))
+
+
+def test_next_batch(conn):
+  source = Producer(conn, "test_key", encoder=dumps)
+  sink = Consumer(conn, "test_key", "test_key_consumer", decoder=loads)
+
+  assert sink.next_batch(10) == []
+  source.put_many(range(0, 2500))
+
+  batch = sink.next_batch(2000)
+  assert [item.value for item in batch] == list(range(0, 2000))
+  batch = sink.next_batch(2000)
+  assert [item.value for item in batch] == list(range(2000, 2500))
+  assert sink.next_batch(2000) == []
+
+
+def test_blocking_get(conn):
+  source = Producer(conn, "test_key", encoder=dumps)
+  sink = Consumer(conn, "test_key", "test_key_consumer", decoder=loads)
+
+  with raises(StopIteration):
+    sink.next(timeout=0.1)
+
+  timer = Timer(0.2, source.put, args=(1,))
+  timer.start()
+  with sink.next(timeout=5) as value:
+    assert value == 1
+  timer.join()
+  sink.close()
+
+
+def test_cancelled_get(conn):
+  queue = WorkQueue(conn, "test_key")
+  cancel = Event()
+
+  def _claims():
+    return conn.info("commandstats").get("cmdstat_evalsha", {}).get("calls", 0)
+
+  # Subscribe, then wait idle making no claims until cancelled
+  Timer(2.5, cancel.set).start()
+  start = time()
+  assert queue.get(timeout=30, cancel=cancel) is None
+  assert time() - start < 5
+
+  # Once subscribed, an idle wait makes no calls at all
+  cancel.clear()
+  Timer(2.5, cancel.set).start()
+  claims = _claims()
+  assert queue.get(timeout=30, cancel=cancel) is None
+  assert _claims() - claims <= 2
+  queue._consumer.close()
+
+
+def test_collect(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+  straggler = Consumer(conn, "test_key", "test_key_straggler", decoder=loads)
+  seq = queue._producer._list
+
+  queue.put_many(range(0, 5000))
+  claimed = queue.get_many(3000)
+
+  # Nothing may be collected while items are leased, or a registered consumer has yet to claim them
+  assert queue.collect() == 0
+  for item in claimed:
+    item.complete()
+  assert queue.collect() == 0
+  straggler.unregister()
+  # Only whole segments wholly behind every consumer are collected
+  assert queue.collect() == 2048
+  with raises(IndexError):
+    seq[2047]
+  assert loads(seq[2048]) == 2048
+
+  # A max length collects whether or not items were consumed
+  queue._retention = {"max_length": 1024}
+  assert queue.collect() == 1024
+  assert [item.value for item in queue.get_many(2)] == [3072, 3073]
+
+
+def test_leases(conn):
+  source = Producer(conn, "test_key", encoder=dumps)
+  sink = Consumer(conn, "test_key", "test_key_consumer", decoder=loads, visibility_timeout=0.5)
+
+  source.put_many(range(0, 4))
+  first, second, third = sink.next_batch(3)
+
+  # Aborting redelivers only the aborted item, ahead of unclaimed items
+  second.abort()
+  first.complete()
+  assert [item.value for item in sink.next_batch(2)] == [1, 3]
+
+  # Abandoned leases are redelivered once they expire, the first to expire first
+  assert sink.next_batch(2) == []
+  with sink.next(timeout=5) as value:
+    assert value == 2
+  sink.close()
+
+
+def test_chunked_layout(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, chunk_size=128)
+  seq = queue._producer._list
+
+  queue.put_many(range(0, 3000))
+  assert loads(seq[129]) == 129
+  assert conn.get(seq.__idx_key__(129)) is None
+
+  claimed = queue.get_many(2100)
+  assert [item.value for item in claimed] == list(range(0, 2100))
+  for item in claimed:
+    item.complete()
+
+  assert queue.collect() == 2048
+  with queue.get() as value:
+    assert value == 2100
+
+
+def test_stats(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+  queue.put_many(range(0, 100))
+  for item in queue.get_many(30):
+    item.complete()
+  queue.get_many(10)
+
+  stats = queue.stats()
+  assert stats["length"] == stats["enqueued"] == 100
+  assert stats["enqueue_rate"][60] == 100 / 60.0
+
+  consumer = stats["consumers"]["test_key/implicit_consumer"]
+  assert consumer["backlog"] == len(queue) == 60
+  assert consumer["inflight"] == 10
+  assert consumer["dequeued"] == 40
+  assert 0 <= consumer["oldest_age"] < 60
+  assert consumer["dequeue_rate"][300] == 40 / 300.0
+
+
+def test_dedupe(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, dedupe=60)
+
+  assert queue.put(1) == 0
+  assert queue.put(1) is None
+  assert queue.put_many([1, 2, 2, 3]) == 1
+  assert queue.put_many([2, 3]) is None
+  assert [item.value for item in queue.get_many(10)] == [1, 2, 3]
+  assert queue.stats()["duplicates"] == 5
+
+
+def test_delayed_delivery(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+
+  assert queue.put(1, delay=0.2) is None
+  queue.put_many([2, 3], delay=0.2)
+  queue.put(0)
+  assert queue.stats()["delayed"] == 3
+
+  # Delayed items are appended in order once due, waking a blocked get
+  assert [item.value for item in queue.get_many(10)] == [0]
+  assert queue.get(timeout=2).value == 1
+  assert [item.value for item in queue.get_many(10)] == [2, 3]
+  assert queue.stats()["delayed"] == 0
+
+
+def test_retry_backoff(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, retry_in=10,
+                    max_retry_delay=30)
+  leases = "test_key/implicit_consumer/leases"
+  queue.put(1)
+
+  # The retry delay doubles with every delivery up to the max, jittered down by up to half
+  for delay in (10, 20, 30, 30):
+    item = queue.get()
+    item.abort()
+    assert queue.get() is None
+    assert delay / 2.0 <= conn.zscore(leases, item._idx) - time() <= delay
+    item.abort(retry_in=0)
+
+  # Completing an item forgets its attempts
+  queue.get().complete()
+  assert not conn.exists(leases, leases + "/attempts")
+
+
+def test_dead_letters(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, max_attempts=2)
+  queue.put_many([1, 2])
+
+  # A poison item is delivered the most attempts, then dead lettered rather than redelivered
+  for _ in range(0, 2):
+    poison = queue.get()
+    assert poison.value == 1
+    poison.abort()
+  with queue.get() as value:
+    assert value == 2
+  assert queue.get() is None
+  assert queue.stats()["dead_lettered"] == 1
+
+  dead = queue.dead_letters()
+  assert len(dead) == 1
+  assert queue.requeue_dead() == 1
+  assert len(dead) == 0
+  assert queue.get().value == 1
+
+
+def test_priority_lanes(conn):
+  strict = PriorityWorkQueue(conn, "test_key", lanes=["live", "backfill"], strategy="strict",
+                             encoder=dumps, decoder=loads)
+  strict.put_many(range(0, 5), lane="backfill")
+  strict.put_many(range(100, 103))
+
+  # Strictly, the live lane jumps the backlog
+  assert [item.value for item in strict.get_many(4)] == [100, 101, 102, 0]
+  with strict.get() as value:
+    assert value == 1
+
+
+def test_weighted_lanes(conn):
+  weighted = PriorityWorkQueue(conn, "test_key", lanes=["live", "backfill"], weights=[3, 1],
+                               encoder=dumps, decoder=loads)
+  weighted.lane("live").put_many(range(100, 200))
+  weighted.put_many(range(0, 100), lane="backfill")
+
+  # By weight, the backfill lane still gets a quarter of claims
+  values = [weighted.get().value for _ in range(0, 40)]
+  assert len([value for value in values if value < 100]) == 10
+
+  # And a lane's items are claimed from the other lanes once it is empty
+  assert len(weighted.get_many(200)) == 160
+  assert weighted.get(timeout=0.1) is None
+
+
+def test_partitions(conn):
+  clock = [1000.0]
+  first = PartitionedWorkQueue(conn, "test_key", partitions=4, route=lambda x: x["user"],
+                               clock=lambda: clock[0], encoder=dumps, decoder=loads)
+  first.put_many([{"user": user, "n": n} for n in range(0, 3) for user in range(0, 8)])
+
+  # Values are routed by key
+  assert len(first) == 24
+  for user in range(0, 8):
+    assert len(first.partition(first.partition_of(user))) >= 3
+
+  # A lone consumer owns every partition
+  assert first.owned() == [0, 1, 2, 3]
+  held = first.partition(3).get()
+
+  # Until another consumer joins, and each takes half once the first heartbeats again
+  second = PartitionedWorkQueue(conn, "test_key", partitions=4, clock=lambda: clock[0],
+                                encoder=dumps, decoder=loads)
+  assert second.owned() == []
+  clock[0] += 10
+  assert first.owned() == [0, 1]
+
+  # But a partition is only consumed by its new owner once its items in flight are done
+  assert second.owned() == [2]
+  held.complete()
+  clock[0] += 10
+  assert second.owned() == [2, 3]
+  assert second.get().value["user"] in [user for user in range(0, 8)
+                                        if second.partition_of(user) in (2, 3)]
+
+  # Every user's values are claimed in order, and only by their partition's owner
+  seen = {}
+  for queue in (first, second):
+    for item in queue.get_many(100):
+      assert queue.partition_of(item.value["user"]) in queue.owned()
+      seen.setdefault(item.value["user"], []).append(item.value["n"])
+      item.complete()
+  assert all(ns == sorted(ns) for ns in seen.values())
+
+  # A consumer which releases its partitions gives them up to the others
+  first.release()
+  clock[0] += 10
+  assert second.owned() == [0, 1, 2, 3]
+
+
+def test_prefetching(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, visibility_timeout=1)
+  leases = "test_key/implicit_consumer/leases"
+  prefetching = PrefetchingQueue(queue, size=4, batch=2, poll=0.1, extend_after=0.3)
+  queue.put_many(range(0, 10))
+
+  # Items are claimed ahead, up to the buffer size
+  with prefetching.get(timeout=2) as value:
+    assert value == 0
+  Event().wait(0.2)
+  assert conn.zcard(leases) == 4
+
+  # Buffered items have their leases renewed rather than timing out
+  Event().wait(1.2)
+  assert conn.zcount(leases, 0, time()) == 0
+  assert [item.value for item in prefetching.get_many(2)] == [1, 2]
+
+  # Closing releases the buffered items, without counting an attempt
+  prefetching.close()
+  assert conn.zcard(leases) == 4
+  assert conn.hget(leases + "/attempts", 3) == b"0"
+  assert sorted(item.value for item in queue.get_many(10)) == list(range(3, 10))
@@ -0,0 +1,73 @@
+from json import dumps, loads
+from threading import Timer
+
+from skrode.redis.stream import WorkQueue
+
+from redis import StrictRedis
+from pytest import fixture
+
+
+@fixture
+def conn():
+  rds = StrictRedis("localhost", db=15)
+  rds.flushdb()
+  return rds
+
+
+def test_produce_consume(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+  queue.put(0)
+  queue.put_many(range(1, 10))
+  assert len(queue) == 10
+
+  with queue.get() as value:
+    assert value == 0
+  assert [item.value for item in queue.get_many(20)] == list(range(1, 10))
+  assert queue.get() is None
+
+  stats = queue.stats()
+  assert stats["length"] == 10
+  assert stats["backlog"] == 0
+  assert stats["inflight"] == 9
+
+
+def test_blocking_get(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+  Timer(0.2, queue.put, args=(1,)).start()
+  assert queue.get(timeout=2).value == 1
+
+
+def test_redelivery(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads, visibility_timeout=0.2,
+                    max_attempts=3)
+  queue.put_many([1, 2])
+
+  # Aborted items are redelivered at once, timed out ones once their lease expires
+  aborted, timed_out = queue.get_many(2)
+  aborted.abort()
+  assert queue.get().value == 1
+  assert queue.get(timeout=2).value == 1
+
+  # Until delivered the most attempts, when they are dead lettered instead
+  assert queue.get(timeout=2).value == 2
+  assert queue.get(timeout=2).value == 2
+  assert queue.get(timeout=0.5) is None
+  dead = queue.dead_letters()
+  assert len(dead) == 2
+  assert queue.requeue_dead() == 2
+  assert sorted(item.value for item in queue.get_many(10)) == [1, 2]
+
+
+def test_collect(conn):
+  queue = WorkQueue(conn, "test_key", encoder=dumps, decoder=loads)
+  queue.put_many(range(0, 10))
+
+  items = queue.get_many(5)
+  items[0].complete()
+  items[1].complete()
+  # Entries up to the oldest pending entry are trimmed
+  assert queue.collect() == 2
+  for item in items[2:]:
+    item.complete()
+  assert queue.collect() == 2
+  assert queue.stats()["length"] == 6
@@ -0,0 +1,38 @@
+from io import BytesIO
+from json import dumps, loads
+
+from skrode.redis.transfer import dump, load
+from skrode.redis.workqueue import WorkQueue
+
+from redis import StrictRedis
+from pytest import fixture, mark
+
+
+@fixture
+def conn():
+  rds = StrictRedis("localhost", db=15)
+  rds.flushdb()
+  return rds
+
+
+@mark.parametrize("format", ["ndjson", "binary"])
+@mark.parametrize("chunk_size", [0, 128])
+def test_round_trip(conn, format, chunk_size):
+  source = WorkQueue(conn, "test_source", encoder=dumps, decoder=loads, chunk_size=chunk_size)
+  source.put_many(range(0, 3000))
+  for item in source.get_many(1024):
+    item.complete()
+  source.collect()
+
+  # Only uncollected items are dumped by default
+  f = BytesIO()
+  assert dump(source, f, format=format, batch=100) == 3000 - 1024
+  assert dump(source, BytesIO(), start=2000, end=2010, format=format) == 10
+
+  target = WorkQueue(conn, "test_target", encoder=dumps, decoder=loads, chunk_size=chunk_size)
+  target.put("existing")
+  f.seek(0)
+  assert load(target, f, format=format, batch=100, pipeline=4) == 3000 - 1024
+
+  # Loaded items are appended in order
+  assert [item.value for item in target.get_many(5000)] == ["existing"] + list(range(1024, 3000))
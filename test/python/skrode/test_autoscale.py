@@ -0,0 +1,74 @@
+from skrode.autoscale import Autoscaler
+
+
+class Queue(object):
+  """A stand-in for a queue with a fixed backlog and dequeue rate."""
+
+  def __init__(self, backlog, rate):
+    self.backlog = backlog
+    self.rate = rate
+
+  def __len__(self):
+    return self.backlog
+
+  def stats(self):
+    return {"length": self.backlog,
+            "consumers": {"test_key/implicit_consumer": {"dequeue_rate": {60: self.rate}},
+                          "test_key/other": {"dequeue_rate": {60: 1000.0}}}}
+
+
+def test_lag():
+  # The backlog is drained at the rate of the implicit consumer alone
+  queue = Queue(100, 2.0)
+  assert Autoscaler("test", queue).lag() == 50.0
+
+  # Without a backlog there is no lag, and without a rate yet it can't be told
+  queue.backlog = 0
+  assert Autoscaler("test", queue).lag() == 0.0
+  queue.backlog, queue.rate = 100, 0.0
+  assert Autoscaler("test", queue).lag() is None
+
+  # Nor can it for a queue which doesn't track dequeue rates
+  queue.stats = lambda: {"length": 100, "backlog": 100, "inflight": 0}
+  assert Autoscaler("test", queue).lag() is None
+
+
+def test_hysteresis():
+  queue = Queue(100, 1.0)
+  scaler = Autoscaler("test", queue, min=1, max=3, scale_up_lag=60, scale_down_lag=10, samples=3,
+                      interval=30)
+
+  # Scales up only once the lag has been high for enough samples, and samples only when due
+  assert [scaler.sample(now) for now in (0, 10, 30)] == [0, 0, 0]
+  assert scaler.sample(60) == 1
+  assert scaler.replicas == 2
+
+  # The run of samples starts over after every change, and after any sample within the thresholds
+  assert [scaler.sample(now) for now in (90, 120)] == [0, 0]
+  queue.rate = 4.0
+  assert scaler.sample(150) == 0
+  queue.rate = 1.0
+  assert [scaler.sample(now) for now in (180, 210, 240)] == [0, 0, 1]
+
+  # Samples without a rate yet are skipped, neither breaking nor extending a run
+  queue.rate = 20.0
+  assert [scaler.sample(now) for now in (270, 300)] == [0, 0]
+  queue.rate = 0.0
+  assert scaler.sample(330) == 0
+  queue.rate = 20.0
+  assert scaler.sample(360) == -1
+  assert scaler.replicas == 2
+
+
+def test_clamps():
+  queue = Queue(100, 1.0)
+  scaler = Autoscaler("test", queue, min=1, max=2, samples=1, interval=1)
+
+  # Never scales beyond the max
+  assert [scaler.sample(now) for now in range(0, 3)] == [1, 0, 0]
+  assert scaler.replicas == 2
+
+  # Nor below the min
+  queue.backlog = 0
+  assert [scaler.sample(now) for now in range(3, 6)] == [-1, 0, 0]
+  assert scaler.replicas == 1
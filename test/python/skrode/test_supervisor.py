@@ -0,0 +1,79 @@
+from skrode.supervisor import CircuitBreaker
+
+
+def test_backoff():
+  breaker = CircuitBreaker("test", backoff=1, max_backoff=5, threshold=10, stable_after=60)
+
+  # Each crash in a row doubles the restart delay, up to the max
+  delays = []
+  for pid in range(0, 5):
+    breaker.started(pid, pid)
+    delays.append(breaker.exited(pid, pid + 1))
+  assert delays == [1, 2, 4, 5, 5]
+  assert breaker.crashes == 5 and breaker.state == CircuitBreaker.CLOSED
+
+  # An exit after running stably restarts at once, and forgets the crashes
+  breaker.started(5, 10)
+  assert breaker.exited(5, 100) == 0
+  assert breaker.crashes == 0
+  breaker.started(6, 100)
+  assert breaker.exited(6, 101) == 1
+
+
+def test_open():
+  breaker = CircuitBreaker("test", backoff=1, max_backoff=30, threshold=3, stable_after=60)
+
+  # Restarts are held once crashes reach the threshold, until the max backoff after the last
+  for pid in range(0, 2):
+    breaker.started(pid, pid)
+    breaker.exited(pid, pid + 1)
+    assert breaker.held_until(pid + 1) is None
+  breaker.started(2, 2)
+  breaker.exited(2, 3)
+  assert breaker.state == CircuitBreaker.OPEN
+  assert breaker.held_until(10) == 33
+  assert breaker.held_until(33) is None
+
+  # Then a single trial is started, holding every other restart while it runs
+  breaker.started(3, 33)
+  assert breaker.state == CircuitBreaker.HALF_OPEN
+  assert breaker.held_until(34) == 93
+
+
+def test_trial_crash():
+  breaker = CircuitBreaker("test", backoff=1, max_backoff=30, threshold=1, stable_after=60)
+  breaker.started(0, 0)
+  breaker.exited(0, 1)
+  breaker.started(1, 31)
+
+  # A trial which crashes reopens the breaker, holding restarts again
+  assert breaker.exited(1, 32) == 2
+  assert breaker.state == CircuitBreaker.OPEN
+  assert breaker.held_until(40) == 62
+
+
+def test_trial_stable():
+  breaker = CircuitBreaker("test", backoff=1, max_backoff=30, threshold=1, stable_after=60)
+  breaker.started(0, 0)
+  breaker.exited(0, 1)
+  breaker.started(1, 31)
+
+  # A trial which runs stably closes the breaker, releasing every held restart
+  breaker.poll(60)
+  assert breaker.state == CircuitBreaker.HALF_OPEN
+  breaker.poll(91)
+  assert breaker.state == CircuitBreaker.CLOSED
+  assert breaker.crashes == 0
+  assert breaker.held_until(91) is None
+
+
+def test_trial_retired():
+  breaker = CircuitBreaker("test", backoff=1, max_backoff=30, threshold=1, stable_after=60)
+  breaker.started(0, 0)
+  breaker.exited(0, 1)
+  breaker.started(1, 31)
+
+  # A trial retired by scaling down proved nothing, so another may start at once
+  breaker.retired(1)
+  assert breaker.state == CircuitBreaker.OPEN
+  assert breaker.held_until(32) is None